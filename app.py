@@ -2,21 +2,39 @@ import os
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
+import anyio
 import fastapi
 import hashlib
+import orjson
+import struct
 import document_db
+import thumbnail
+from page_cache import page_cache
+from result_cache import search_cache
+from static_assets import static_assets
+from variant_cache import snap_width, variant_cache
+from tag_index import tag_index
+import bisect
 from document_sql import *
-from site_utils import archived_document_path, get_zip_namelist, get_zip_image, thumbnail_folder
+from site_utils import archived_document_path, get_archive_index, get_zip_namelist, EntryOffset, iter_zip_entry, \
+    read_zip_entry, ArchiveIndex
 from contextlib import asynccontextmanager
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 from pathlib import Path
 from pydantic import BaseModel
 from email.utils import formatdate
-from shared import Authoricator, DEFAULT_AUTH_TOKEN, get_db, PAGE_COUNT, task_status, TaskStatus
+from typing import Iterator, NamedTuple, Optional, Sequence
+from shared import Authoricator, DEFAULT_AUTH_TOKEN, get_async_db, get_db, get_task_status_snapshot, PAGE_COUNT, \
+    remove_task_status, task_status, task_updates, TaskStatus
 import asyncio
 from setup_logger import get_logger
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 logger = get_logger('Site')
 hitomi_router = None
 
@@ -37,9 +55,25 @@ app_kwargs = {"docs_url": None, "redoc_url": None, "openapi_url": None}
 async def lifespan(app_instance: fastapi.FastAPI):
     # 如果插件存在，启动插件的后台任务
     hitomi_bg_task = None
+    with document_db.DocumentDB() as db:
+        tag_index.load(db.session)
+    static_assets.load()
+    download_task = None
     if hitomi_plugin:
         hitomi_bg_task = asyncio.create_task(hitomi_plugin.refresh_hitomi_loop())
+        download_task = asyncio.create_task(hitomi_plugin.download_queue.run())
     yield
+    # 下载任务先停, 被中断的任务在库里保持 running, 下次启动时重新排队
+    if download_task:
+        download_task.cancel()
+        try:
+            await download_task
+        except asyncio.CancelledError:
+            pass
+    thumbnail.shutdown_executor()
+    page_cache.shutdown()
+    document_db.shutdown_db_executor()
+    document_db.shutdown_writers()
     # 清理任务
     if hitomi_bg_task:
         hitomi_bg_task.cancel()
@@ -103,23 +137,35 @@ async def give_icon() -> fastapi.responses.FileResponse:
 
 
 @app.get('/src/{filename}',
-         response_class=fastapi.responses.FileResponse,
          dependencies=[fastapi.Depends(Authoricator())])
-async def give_src(filename: str) -> fastapi.responses.FileResponse:
-    file_path = Path(f'src/{filename}')
-    if not file_path.exists():
+async def give_src(request: fastapi.Request, filename: str) -> fastapi.Response:
+    response = static_assets.asset_response(request, filename)
+    if response is None:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND)
-    return fastapi.responses.FileResponse(path=file_path)
+    return response
 
 
 class SearchDocumentRequest(BaseModel):
     target_tag: int | None = None
     author_name: str | None = None
     target_page: int | None = 1
+    # 游标分页: 上一页返回的 next_cursor, 给出时忽略 target_page
+    cursor: int | None = None
+    with_total: bool = True
+    # 多标签组合: 全部包含 / 至少包含一个 / 全部排除, target_tag 视为 include_tags 的一员
+    include_tags: list[int] | None = None
+    any_tags: list[int] | None = None
+    exclude_tags: list[int] | None = None
+    # 返回整个结果集上的 标签id -> 文档数
+    with_facets: bool = False
+    # 在标题、系列名、作者名中全文检索, 结果按相关度排序
+    keyword: str | None = None
 
 
 class SearchDocumentResponse(BaseModel):
-    total_count: int
+    total_count: int | None
+    next_cursor: int | None = None
+    facets: dict[int, int] | None = None
     document_authors: dict[int, list[str]]
     documents_info: dict[int, Document]
     tags: dict[int, list[Tag]]
@@ -148,8 +194,9 @@ async def add_document_gateway(source_document_id: str, source_id: int):
 @app.get('/get_document/{source_document_id}',
          status_code=fastapi.status.HTTP_307_TEMPORARY_REDIRECT,
          dependencies=[fastapi.Depends(Authoricator())])
-async def get_document(source_document_id: str, db: document_db.DocumentDB = fastapi.Depends(get_db)):
-    db_result = db.search_by_source(source_document_id=source_document_id)
+async def get_document(source_document_id: str,
+                       db: document_db.AsyncDocumentDB = fastapi.Depends(get_async_db)):
+    db_result = await db.search_by_source(source_document_id=source_document_id)
     if db_result:
         return fastapi.responses.RedirectResponse(url=f'/show_document/{db_result.document_id}')
     raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND)
@@ -158,65 +205,305 @@ async def get_document(source_document_id: str, db: document_db.DocumentDB = fas
 @app.get('/show_status',
          response_class=fastapi.responses.HTMLResponse,
          dependencies=[fastapi.Depends(Authoricator())])
-async def get_download_status():
-    return fastapi.responses.FileResponse('templates/show_download_status.html')
+async def get_download_status(request: fastapi.Request):
+    return static_assets.template_response(request, 'show_download_status.html')
 
 
 @app.get('/download_status',
          dependencies=[fastapi.Depends(Authoricator())])
 async def get_status() -> dict[str, TaskStatus]:
-    return task_status
+    return get_task_status_snapshot()
+
+
+# 同一连接两次推送之间的最短间隔, 期间的多次进度变化合并成一条
+STATUS_EVENT_INTERVAL = float(os.environ.get('STATUS_EVENT_INTERVAL', 0.5))
+# 没有变化时隔这么久发一条注释, 防止代理断开空闲连接
+STATUS_KEEPALIVE_INTERVAL = 15
+
+
+def format_status_event(event: str, payload: dict) -> bytes:
+    return b'event: ' + event.encode() + b'\ndata: ' + orjson.dumps(payload) + b'\n\n'
+
+
+@app.get('/download_events',
+         dependencies=[fastapi.Depends(Authoricator())])
+async def get_status_events(request: fastapi.Request) -> fastapi.responses.StreamingResponse:
+    """
+    下载进度的 Server-Sent Events 流: 连接后先发一条 snapshot 为完整状态,
+    之后每条 update 只含变化过的任务, 已移除的任务值为 null
+    """
+    subscriber = task_updates.subscribe()
+
+    async def stream():
+        try:
+            yield format_status_event('snapshot', {key: status.model_dump()
+                                                   for key, status in get_task_status_snapshot().items()})
+            while not await request.is_disconnected():
+                try:
+                    await asyncio.wait_for(subscriber.changed.wait(), STATUS_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                # 攒一个间隔再发, 期间同一任务的多次变化只发最后的状态
+                await asyncio.sleep(STATUS_EVENT_INTERVAL)
+                changes = {}
+                for key in subscriber.take():
+                    status = task_status.get(key)
+                    changes[key] = status.model_dump() if status is not None else None
+                yield format_status_event('update', changes)
+        finally:
+            task_updates.unsubscribe(subscriber)
+
+    return fastapi.responses.StreamingResponse(stream(), media_type='text/event-stream',
+                                               headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.delete('/delete_document', dependencies=[fastapi.Depends(Authoricator())])
-def delete_document(document_id: int, auth_token: str, db: document_db.DocumentDB = fastapi.Depends(get_db)):
+def delete_document(document_id: int, auth_token: str):
     if auth_token != 'MisonoMika':
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_403_FORBIDDEN, detail='你只能看')
-    result = db.delete_document(document_id)
+    result = document_db.get_writer().call(document_db.DocumentDB.delete_document, document_id)
     if result != 0:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST, detail='文档不存在')
 
 
-@app.post('/search_document', dependencies=[fastapi.Depends(Authoricator())])
+def get_search_cache_key(request: SearchDocumentRequest) -> tuple:
+    """把请求规整成缓存键: 标签列表去重排序, 关键词去掉首尾空白, 页码缺省为 1"""
+    normalize = lambda tags: tuple(sorted(set(tags))) if tags else ()
+    return (request.target_tag, request.author_name, request.target_page or 1, request.cursor,
+            request.with_total, normalize(request.include_tags), normalize(request.any_tags),
+            normalize(request.exclude_tags), request.with_facets,
+            request.keyword.strip() if request.keyword else None, PAGE_COUNT)
+
+
+class SearchPage(NamedTuple):
+    total_count: Optional[int]
+    next_cursor: Optional[int]
+    facets: Optional[dict[int, int]]
+    # 已预加载作者与标签, 按应显示的顺序排列
+    documents: Sequence[Document]
+
+
+def to_search_response(page: SearchPage) -> SearchDocumentResponse:
+    return SearchDocumentResponse(
+        total_count=page.total_count,
+        next_cursor=page.next_cursor,
+        facets=page.facets,
+        documents_info={document.document_id: document for document in page.documents},
+        document_authors={document.document_id: [author.name for author in document.authors] for document in
+                          page.documents},
+        tags={document.document_id: document.tags for document in page.documents})
+
+
+def to_columnar_payload(page: SearchPage) -> dict:
+    """
+    扁平的列式结果: 每个字段一个与 document_ids 对齐的数组, 作者与标签只给 id,
+    名字放在共享字典里, 同一个标签在一页里出现多少次都只传一遍
+    """
+    author_names: dict[int, str] = {}
+    tag_names: dict[int, str] = {}
+    tag_group_ids: dict[int, Optional[int]] = {}
+    author_ids: list[list[int]] = []
+    tag_ids: list[list[int]] = []
+    for document in page.documents:
+        for author in document.authors:
+            author_names[author.author_id] = author.name
+        for tag in document.tags:
+            tag_names[tag.tag_id] = tag.name
+            tag_group_ids[tag.tag_id] = tag.group_id
+        author_ids.append([author.author_id for author in document.authors])
+        tag_ids.append([tag.tag_id for tag in document.tags])
+    return {
+        'total_count': page.total_count,
+        'next_cursor': page.next_cursor,
+        'facets': page.facets,
+        'document_ids': [document.document_id for document in page.documents],
+        'titles': [document.title for document in page.documents],
+        'series_names': [document.series_name for document in page.documents],
+        'volume_numbers': [document.volume_number for document in page.documents],
+        'author_ids': author_ids,
+        'tag_ids': tag_ids,
+        'author_names': author_names,
+        'tag_names': tag_names,
+        'tag_group_ids': tag_group_ids
+    }
+
+
+@app.post('/search_document', dependencies=[fastapi.Depends(Authoricator())],
+          response_model=SearchDocumentResponse)
 def search_document(request: SearchDocumentRequest,
-                    db: document_db.DocumentDB = fastapi.Depends(get_db)) -> SearchDocumentResponse:
+                    db: document_db.DocumentDB = fastapi.Depends(get_db)) -> fastapi.Response:
+    # 命中时直接返回序列化好的 JSON, 既不查库也不经过 Pydantic
+    cache_key = ('nested', get_search_cache_key(request))
+    generation = document_db.get_catalog_generation()
+    content = search_cache.get(cache_key, generation)
+    if content is None:
+        content = to_search_response(run_search_document(request, db)).model_dump_json().encode()
+        search_cache.put(cache_key, generation, content)
+    return fastapi.Response(content=content, media_type='application/json')
+
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+
+@app.post('/search_document_columns', dependencies=[fastapi.Depends(Authoricator())])
+def search_document_columns(request: SearchDocumentRequest,
+                            http_request: fastapi.Request,
+                            db: document_db.DocumentDB = fastapi.Depends(get_db)) -> fastapi.Response:
+    """
+    与 /search_document 相同的查询, 返回列式结果, 不经过 Pydantic
+    默认用 orjson 编码为 JSON; Accept 中包含 application/msgpack 且装了 msgpack 时改用 msgpack
+    """
+    use_msgpack = msgpack is not None and MSGPACK_MEDIA_TYPE in http_request.headers.get('accept', '')
+    media_type = MSGPACK_MEDIA_TYPE if use_msgpack else 'application/json'
+    cache_key = (media_type, get_search_cache_key(request))
+    generation = document_db.get_catalog_generation()
+    content = search_cache.get(cache_key, generation)
+    if content is None:
+        payload = to_columnar_payload(run_search_document(request, db))
+        if use_msgpack:
+            content = msgpack.packb(payload)
+        else:
+            content = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        search_cache.put(cache_key, generation, content)
+    return fastapi.Response(content=content, media_type=media_type, headers={'Vary': 'Accept'})
+
+
+def run_search_document(request: SearchDocumentRequest, db: document_db.DocumentDB) -> SearchPage:
     if request.target_page is None:
         target_page = 1
     else:
         target_page = request.target_page
+    include_tags = list(request.include_tags or [])
     if request.target_tag:
-        total_count, documents_info = db.paginate_query(db.query_by_tags([request.target_tag]),
-                                                        target_page, PAGE_COUNT)
-    elif request.author_name:
-        total_count, documents_info = db.paginate_query(db.query_by_author(request.author_name),
-                                                        target_page, PAGE_COUNT)
+        include_tags.append(request.target_tag)
+    keyword = request.keyword.strip() if request.keyword else None
+    if include_tags or request.any_tags or request.exclude_tags or request.with_facets:
+        # 标签组合只在标签索引上计算; 通常启动时已载入, 没载入 (例如启动时失败) 就在这里补上
+        if not tag_index.loaded:
+            tag_index.load(db.session)
+        return search_by_tag_index(request, include_tags, target_page, keyword, db)
+    if keyword:
+        # 相关度排序与 document_id 游标不兼容, 关键词检索只按页码分页
+        total_count, documents_info = db.paginate_query(
+            db.query_by_keyword(keyword, eager=True, author_name=request.author_name), target_page, PAGE_COUNT,
+            with_count=request.with_total)
+        return SearchPage(total_count, None, None, documents_info)
+    # 响应里要用到每个文档的作者和标签, 必须预加载, 否则每行都会触发懒加载查询
+    if request.author_name:
+        statement = db.query_by_author(request.author_name, eager=True)
     else:
-        total_count, documents_info = db.paginate_query(db.query_all_documents(), target_page, PAGE_COUNT)
-    return SearchDocumentResponse(
-        total_count=total_count,
-        documents_info={document.document_id: document for document in documents_info},
-        document_authors={document.document_id: [author.name for author in document.authors] for document in
-                          documents_info},
-        tags={document.document_id: document.tags for document in documents_info})
-
-
-def generate_thumbnail(document_id: int, file_path: Path):
-    pic_list = get_zip_namelist(file_path)
-    assert isinstance(pic_list, list)
-    if not pic_list:
-        return
-
-    thumbnail_content = get_zip_image(file_path, pic_list[0])
-    if not thumbnail_folder.exists():
-        thumbnail_folder.mkdir()
-
-    with open(thumbnail_folder / Path(f'{document_id}.webp'), "wb") as fu:
-        fu.write(thumbnail_content.read())
+        statement = db.query_all_documents(eager=True)
+    # 按页码请求时跳过前面的页, 同样多取一条来判断有没有下一页, 结果数恰为页大小整数倍时也不会给出越界的游标
+    offset = (target_page - 1) * PAGE_COUNT if request.cursor is None else 0
+    total_count, documents_info, next_cursor = db.paginate_keyset(statement, request.cursor, PAGE_COUNT,
+                                                                  with_count=request.with_total, offset=offset)
+    return SearchPage(total_count, next_cursor, None, documents_info)
+
+
+def search_by_tag_index(request: SearchDocumentRequest, include_tags: list[int], target_page: int,
+                        keyword: Optional[str], db: document_db.DocumentDB) -> SearchPage:
+    # 标签组合在内存倒排索引里算出完整的 id 列表, 数据库只负责取当页的文档
+    tag_index.refresh_if_stale(db.session)
+    matched_ids = tag_index.query(include_tags, request.any_tags or (), request.exclude_tags or ())
+    if request.author_name:
+        author_ids = {document.document_id for document in db.search_by_author(request.author_name)}
+        matched_ids = [doc_id for doc_id in matched_ids if doc_id in author_ids]
+    if keyword:
+        # 与标签组合同时使用时只筛选, 结果仍按 document_id 降序, 不按相关度
+        keyword_ids = db.get_keyword_document_ids(keyword)
+        matched_ids = [doc_id for doc_id in matched_ids if doc_id in keyword_ids]
+    if request.cursor is not None:
+        end = bisect.bisect_left(matched_ids, request.cursor)
+    else:
+        end = len(matched_ids) - (target_page - 1) * PAGE_COUNT
+    start = max(0, end - PAGE_COUNT)
+    page_ids = matched_ids[start:end] if end > 0 else []
+    return SearchPage(
+        total_count=len(matched_ids) if request.with_total else None,
+        next_cursor=page_ids[0] if start > 0 and page_ids else None,
+        facets=tag_index.facet_counts(matched_ids) if request.with_facets else None,
+        documents=db.get_documents_by_ids(page_ids, eager=True))
+
+
+# 流式发送页面时每块的大小
+CONTENT_CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveEntryResponse(fastapi.responses.Response):
+    """
+    把归档中未压缩条目对应的字节区间直接发给客户端, 不经过内存拷贝
+    服务器支持 zerocopysend 扩展时交给 sendfile, 否则按块读取发送
+    """
+    chunk_size = CONTENT_CHUNK_SIZE
+
+    def __init__(self, path: Path, entry: EntryOffset,
+                 headers: Optional[dict[str, str]] = None,
+                 media_type: Optional[str] = None):
+        self.path = path
+        self.entry = entry
+        self.status_code = fastapi.status.HTTP_200_OK
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers['content-length'] = str(entry.length)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            with open(self.path, 'rb') as fp:
+                await send({'type': 'http.response.zerocopysend',
+                            'file': fp.fileno(),
+                            'offset': self.entry.data_offset,
+                            'count': self.entry.length,
+                            'more_body': False})
+            return
+        async with await anyio.open_file(self.path, 'rb') as fp:
+            await fp.seek(self.entry.data_offset)
+            remaining = self.entry.length
+            while remaining > 0:
+                chunk = await fp.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise RuntimeError(f'{self.path} 在读取条目时提前结束')
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if self.entry.length == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def create_thumbnail_response(request: fastapi.Request, document: Document,
+                              width: Optional[int] = None) -> fastapi.responses.Response:
+    """缩略图会重新生成, ETag 取自文件的修改时间与大小, 内容变了客户端缓存随之失效"""
+    # 缩略图只有预先生成的几档, 取不小于请求宽度的一档, 都不够就用最大的
+    thumbnail_width = None
+    if width is not None:
+        thumbnail_width = snap_width(width, thumbnail.THUMBNAIL_SIZES) or max(thumbnail.THUMBNAIL_SIZES)
+    thumbnail_path = thumbnail.get_thumbnail_path(document.document_id, thumbnail_width)
+    if not thumbnail_path.exists():
+        thumbnail.generate_thumbnails_sync(document.document_id, archived_document_path / document.file_path)
+    try:
+        stat = thumbnail_path.stat()
+    except FileNotFoundError:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail='文档没有可用的页面')
+    current_etag = hashlib.md5(f"{thumbnail_path.name}-{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()
+    if request.headers.get("if-none-match") == current_etag:
+        return fastapi.Response(status_code=fastapi.status.HTTP_304_NOT_MODIFIED, headers={"ETag": current_etag})
+    headers = {
+        "Cache-Control": "public, max-age=2678400",
+        "ETag": current_etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True)
+    }
+    return fastapi.responses.FileResponse(path=thumbnail_path, headers=headers)
 
 
 def create_content_response(request: fastapi.Request, document: Document,
-                            file_index: int) -> fastapi.responses.Response:
-    current_etag = hashlib.md5(f"{document.file_path}-{file_index}".encode()).hexdigest()
+                            file_index: int, width: Optional[int] = None) -> fastapi.responses.Response:
+    if file_index == -1:
+        return create_thumbnail_response(request, document, width)
+    current_etag = hashlib.md5(f"{document.file_path}-{file_index}-{width}".encode()).hexdigest()
     if request.headers.get("if-none-match") == current_etag:
         return fastapi.Response(status_code=fastapi.status.HTTP_304_NOT_MODIFIED, headers={"ETag": current_etag})
     # 构造通用 Header
@@ -229,22 +516,32 @@ def create_content_response(request: fastapi.Request, document: Document,
     }
     # 6. 未命中缓存：返回完整数据
     document_path = archived_document_path / document.file_path
-    if file_index == -1:
-        thumbnail_path = thumbnail_folder / Path(f'{document.document_id}.webp')
-        if not thumbnail_path.exists():
-            generate_thumbnail(document.document_id, document_path)
-        return fastapi.responses.FileResponse(path=thumbnail_path)
-    file_namelist = get_zip_namelist(document_path)
+    archive_index = get_archive_index(document_path)
+    if archive_index is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail='无法获取文档内容')
     try:
-        file_name = file_namelist[file_index]
+        file_name = archive_index.names[file_index]
     except IndexError:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail='索引超出范围')
-    content = get_zip_image(document_path, file_name)
-    if content is None:
-        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail='无法获取文档内容')
-    return fastapi.responses.Response(
-        content=content.read(),
-        media_type=f"image/webp",
+    if width is not None:
+        variant_width = snap_width(width)
+        variant_path = variant_cache.get(archive_index, file_name, variant_width) if variant_width else None
+        if variant_path is not None:
+            return fastapi.responses.FileResponse(path=variant_path, media_type="image/webp", headers=headers)
+    page_cache.record_access(archive_index, file_index)
+    cached_content = page_cache.get(archive_index, file_name)
+    if cached_content is not None:
+        return fastapi.responses.Response(content=cached_content, media_type="image/webp", headers=headers)
+    entry = archive_index.offsets[file_name]
+    if entry.is_stored:
+        # 归档里的 webp 本身已压缩, 下载时按 STORED 存放, 直接发文件区间
+        return ArchiveEntryResponse(document_path, entry, headers=headers, media_type='image/webp')
+    # 压缩过的条目边解压边发送, 同步迭代器由 starlette 放到线程池里逐块拉取,
+    # 发送端阻塞时不会继续解压, 内存占用以块大小为界
+    headers['Content-Length'] = str(entry.file_size)
+    return fastapi.responses.StreamingResponse(
+        iter_zip_entry(document_path, file_name, CONTENT_CHUNK_SIZE),
+        media_type="image/webp",
         headers=headers
     )
 
@@ -263,16 +560,18 @@ def get_document_namelist(document_id: int,
     pic_list = get_zip_namelist(file_path)
     if isinstance(pic_list, str):
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail=pic_list)
-    if document.title in task_status:
-        task_status.pop(document.title)
+    # 看过的本子不再显示在下载进度里
+    if task_status:
+        for source_document_id in db.get_source_document_ids(document_id):
+            remove_task_status(source_document_id)
     return [f'/document_content/{document_id}/{i}' for i in range(len(pic_list))]
 
 
 @app.get('/show_document/{document_id}',
          response_class=fastapi.responses.HTMLResponse,
          dependencies=[fastapi.Depends(Authoricator())])
-def show_document():
-    return fastapi.responses.FileResponse('templates/gallery.html')
+def show_document(request: fastapi.Request):
+    return static_assets.template_response(request, 'gallery.html')
 
 
 @app.get('/document_content/{document_id}/{content_index}',
@@ -287,18 +586,95 @@ def show_document():
 def get_document_content(request: fastapi.Request,
                          document_id: int,
                          content_index: int,
+                         w: Optional[int] = None,
                          db: document_db.DocumentDB = fastapi.Depends(get_db)) -> fastapi.responses.Response:
     if document_id < 0:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST)
     if content_index < -1:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST)
+    if w is not None and w <= 0:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST)
     document = db.get_document_by_id(document_id)
     if document is None:
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND)
     file_path = archived_document_path / document.file_path
     if not file_path.exists():
         raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND)
-    return create_content_response(request, document, content_index)
+    return create_content_response(request, document, content_index, w)
+
+
+# 批量接口单次最多返回的页数
+MAX_BATCH_PAGES = 32
+# 批量接口的帧头: 页码 + 页面字节数, 均为大端 uint32
+BATCH_FRAME_HEADER = struct.Struct('>II')
+
+
+def iter_batch_frames(archive_index: ArchiveIndex, start: int, end: int,
+                      width: Optional[int] = None) -> Iterator[bytes]:
+    variant_width = snap_width(width) if width is not None else None
+    for page_no in range(start, end):
+        file_name = archive_index.names[page_no]
+        variant_path = variant_cache.get(archive_index, file_name, variant_width) if variant_width else None
+        if variant_path is not None:
+            content = variant_path.read_bytes()
+        else:
+            content = page_cache.get(archive_index, file_name)
+        if content is None:
+            content = read_zip_entry(archive_index.zip_path, file_name)
+        if content is None:
+            raise RuntimeError(f'{archive_index.zip_path} 中的 {file_name} 读取失败')
+        yield BATCH_FRAME_HEADER.pack(page_no, len(content))
+        yield content
+
+
+@app.get('/document_batch/{document_id}',
+         responses={
+             fastapi.status.HTTP_200_OK: {
+                 "description": "连续的二进制帧, 每帧为 4 字节页码 + 4 字节长度 (大端) + 页面内容",
+                 "content": {"application/octet-stream": {}}
+             }
+         },
+         dependencies=[fastapi.Depends(Authoricator())])
+def get_document_batch(request: fastapi.Request,
+                       document_id: int,
+                       start: int = 0,
+                       count: int = 16,
+                       w: Optional[int] = None,
+                       db: document_db.DocumentDB = fastapi.Depends(get_db)) -> fastapi.responses.Response:
+    if document_id < 0 or start < 0 or count <= 0 or (w is not None and w <= 0):
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_400_BAD_REQUEST)
+    document = db.get_document_by_id(document_id)
+    if document is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND)
+    document_path = archived_document_path / document.file_path
+    archive_index = get_archive_index(document_path)
+    if archive_index is None:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND)
+    end = min(start + min(count, MAX_BATCH_PAGES), len(archive_index))
+    if start >= end:
+        raise fastapi.HTTPException(status_code=fastapi.status.HTTP_404_NOT_FOUND, detail='索引超出范围')
+    current_etag = hashlib.md5(f"{document.file_path}-batch-{start}-{end}-{w}".encode()).hexdigest()
+    if request.headers.get("if-none-match") == current_etag:
+        return fastapi.Response(status_code=fastapi.status.HTTP_304_NOT_MODIFIED, headers={"ETag": current_etag})
+    # 比所有档位都宽的请求与不带宽度的请求一样发原图, 同样需要预读
+    if w is None or snap_width(w) is None:
+        # 客户端读完这一批大概率会要下一批, 先放进缓存
+        page_cache.prefetch(archive_index, end, end - start)
+    headers = {
+        "Cache-Control": "public, max-age=2678400",
+        "ETag": current_etag,
+        "X-Page-Start": str(start),
+        "X-Page-End": str(end),
+        "X-Page-Total": str(len(archive_index))
+    }
+    return fastapi.responses.StreamingResponse(iter_batch_frames(archive_index, start, end, w),
+                                               media_type='application/octet-stream',
+                                               headers=headers)
+
+
+@app.get('/cache_stats', dependencies=[fastapi.Depends(Authoricator())])
+def get_cache_stats() -> dict[str, int | float | dict]:
+    return {**page_cache.stats(), 'search_cache': search_cache.stats()}
 
 
 @app.get('/get_tags/{group_id}', dependencies=[fastapi.Depends(Authoricator())])
@@ -317,8 +693,8 @@ def get_tag_groups(db: document_db.DocumentDB = fastapi.Depends(get_db)):
 @app.get('/exploror',
          response_class=fastapi.responses.HTMLResponse,
          dependencies=[fastapi.Depends(Authoricator())])
-def exploror():
-    return fastapi.responses.FileResponse(path='templates/exploror.html')
+def exploror(request: fastapi.Request):
+    return static_assets.template_response(request, 'exploror.html')
 
 
 @app.get('/', dependencies=[fastapi.Depends(Authoricator())])
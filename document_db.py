@@ -1,15 +1,24 @@
 import asyncio
+import functools
 import os
+import queue
 import shutil
 import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Union, List, Iterable, Sequence
+from typing import Any, Callable, NamedTuple, Optional, Union, List, Iterable, Sequence, TypeVar
+import sqlalchemy
 import sqlmodel
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
 # noinspection PyProtectedMember
 from sqlmodel.sql._expression_select_cls import SelectOfScalar
 
 import document_sql
+from tag_cache import hitomi_tag_cache
+from tag_index import tag_index
 
 try:
     from site_utils import get_file_hash, archived_document_path, get_zip_namelist, get_zip_image, thumbnail_folder
@@ -32,19 +41,213 @@ except ImportError:
     getZipImage = None
 
 
+# 目录代数: 本进程每次成功写库后加一, 各类查询缓存据此判断条目是否过期
+_generation_lock = threading.Lock()
+_catalog_generation = 0
+
+
+def get_catalog_generation() -> int:
+    return _catalog_generation
+
+
+def bump_catalog_generation():
+    global _catalog_generation
+    with _generation_lock:
+        _catalog_generation += 1
+
+
+# 分页总数缓存: 语句文本 -> (目录代数, 计算时间, 总数)
+# 本进程的写入通过代数立即失效, 其他进程的写入最迟 COUNT_CACHE_TTL 秒后生效
+COUNT_CACHE_TTL = 60
+MAX_COUNT_CACHE_ENTRIES = 1024
+_count_cache: dict[str, tuple[int, float, int]] = {}
+
+
+# ==========================================
+# 全文检索 (FTS5, trigram 分词, 对中日文按三字切分也能搜)
+# ==========================================
+
+# 重建某个文档在全文索引中的行: 标题, 系列名, 以空格连接的作者名
+_FTS_REFRESH_SQL = """
+    DELETE FROM documents_fts WHERE rowid = {doc};
+    INSERT INTO documents_fts (rowid, title, series_name, authors)
+    SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+           coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da
+                     JOIN authors a ON a.author_id = da.author_id
+                     WHERE da.document_id = d.document_id), '')
+    FROM documents d WHERE d.document_id = {doc};
+"""
+
+FULLTEXT_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(title, series_name, authors, tokenize='trigram')",
+    f"""CREATE TRIGGER IF NOT EXISTS documents_fts_ai AFTER INSERT ON documents BEGIN
+        {_FTS_REFRESH_SQL.format(doc='NEW.document_id')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS documents_fts_au AFTER UPDATE OF title, series_name ON documents BEGIN
+        {_FTS_REFRESH_SQL.format(doc='NEW.document_id')}
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS documents_fts_ad AFTER DELETE ON documents BEGIN
+        DELETE FROM documents_fts WHERE rowid = OLD.document_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS documents_fts_dai AFTER INSERT ON document_authors BEGIN
+        {_FTS_REFRESH_SQL.format(doc='NEW.document_id')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS documents_fts_dad AFTER DELETE ON document_authors BEGIN
+        {_FTS_REFRESH_SQL.format(doc='OLD.document_id')}
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS documents_fts_aau AFTER UPDATE OF name ON authors BEGIN
+        DELETE FROM documents_fts WHERE rowid IN
+            (SELECT document_id FROM document_authors WHERE author_id = NEW.author_id);
+        INSERT INTO documents_fts (rowid, title, series_name, authors)
+        SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+               coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da2
+                         JOIN authors a ON a.author_id = da2.author_id
+                         WHERE da2.document_id = d.document_id), '')
+        FROM documents d
+        WHERE d.document_id IN (SELECT document_id FROM document_authors WHERE author_id = NEW.author_id);
+    END""",
+]
+
+# trigram 分词器匹配不了少于三个字符的片段, 更短的关键词退回 LIKE
+FTS_MIN_KEYWORD_LENGTH = 3
+
+documents_fts = sqlalchemy.table('documents_fts', sqlalchemy.column('rowid'), sqlalchemy.column('rank'))
+
+
+def setup_fulltext(engine: sqlalchemy.Engine):
+    """建立全文索引表与同步触发器, 表是新建的则用现有文档填充一次"""
+    with engine.begin() as conn:
+        existed = conn.execute(sqlmodel.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'documents_fts'")).first()
+        for ddl in FULLTEXT_DDL:
+            conn.execute(sqlmodel.text(ddl))
+        if not existed:
+            conn.execute(sqlmodel.text(
+                "INSERT INTO documents_fts (rowid, title, series_name, authors) "
+                "SELECT d.document_id, d.title, coalesce(d.series_name, ''), "
+                "coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da "
+                "JOIN authors a ON a.author_id = da.author_id WHERE da.document_id = d.document_id), '') "
+                "FROM documents d"))
+
+
+def build_fts_query(keyword: str) -> Optional[str]:
+    """把用户输入切成若干短语, 每段按字面匹配, 段与段之间为 AND; 有任何一段过短时返回 None"""
+    terms = keyword.split()
+    if not terms or any(len(term) < FTS_MIN_KEYWORD_LENGTH for term in terms):
+        return None
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+# ==========================================
+# 引擎与连接池 (每个数据库文件每个进程只建一次)
+# ==========================================
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 16))
+# 每个连接建立时设置一次的 PRAGMA
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# 负数表示 KiB, 即每个连接 64MB 页缓存
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -64 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+
+_engines: dict[str, sqlalchemy.Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    finally:
+        cursor.close()
+
+
+def _set_writer_isolation(dbapi_connection, _connection_record):
+    # 交给 SQLAlchemy 自己发 BEGIN, 否则 pysqlite 会在第一个 SAVEPOINT 处自行开启并提前提交事务
+    dbapi_connection.isolation_level = None
+
+
+def _begin_immediate(conn: sqlalchemy.Connection):
+    # 写连接一开始就拿写锁, 避免读锁升级写锁时与其他进程互相等待
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def create_writer_engine(db_file_name: str = "documents.db") -> sqlalchemy.Engine:
+    """写入线程专用的单连接引擎, 支持嵌套 SAVEPOINT"""
+    get_engine(db_file_name)
+    engine = sqlmodel.create_engine(f"sqlite:///{db_file_name}",
+                                    connect_args={'check_same_thread': False},
+                                    poolclass=sqlalchemy.pool.QueuePool,
+                                    pool_size=1,
+                                    max_overflow=0)
+    sqlalchemy.event.listen(engine, 'connect', _set_sqlite_pragmas)
+    sqlalchemy.event.listen(engine, 'connect', _set_writer_isolation)
+    sqlalchemy.event.listen(engine, 'begin', _begin_immediate)
+    return engine
+
+
+def setup_schema(engine: sqlalchemy.Engine):
+    # 自动创建表结构（如果是新库）
+    sqlmodel.SQLModel.metadata.create_all(engine)
+    # create_all 只在建表时建索引, 老库上补建后来新增的索引
+    for table in sqlmodel.SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    setup_fulltext(engine)
+
+
+def get_engine(db_file_name: str = "documents.db") -> sqlalchemy.Engine:
+    """返回进程内共享的引擎, 第一次取用时建表, 之后每次请求只是从池里借一个连接"""
+    engine = _engines.get(db_file_name)
+    if engine is not None:
+        return engine
+    with _engines_lock:
+        engine = _engines.get(db_file_name)
+        if engine is None:
+            engine = sqlmodel.create_engine(f"sqlite:///{db_file_name}",
+                                            connect_args={'check_same_thread': False},
+                                            poolclass=sqlalchemy.pool.QueuePool,
+                                            pool_size=DB_POOL_SIZE,
+                                            max_overflow=DB_MAX_OVERFLOW)
+            sqlalchemy.event.listen(engine, 'connect', _set_sqlite_pragmas)
+            setup_schema(engine)
+            _engines[db_file_name] = engine
+        return engine
+
+
+class NewDocument(NamedTuple):
+    """add_documents 的一条输入"""
+    title: str
+    filepath: Union[str, Path]
+    authors: Sequence[str] = ()
+    # 标签 id 或已入库的 Tag
+    tags: Sequence[int | document_sql.Tag] = ()
+    # (source_id, source_document_id)
+    sources: Sequence[tuple[int, str]] = ()
+    series: Optional[str] = None
+    volume: Optional[int] = None
+    given_id: Optional[int] = None
+
+
 # ==========================================
 # 核心数据库管理类
 # ==========================================
 
 class DocumentDB:
-    def __init__(self, db_file_name: str = "documents.db"):
-        sqlite_url = f"sqlite:///{db_file_name}"
-        self.engine = sqlmodel.create_engine(sqlite_url)
-        # 自动创建表结构（如果是新库）
-        sqlmodel.SQLModel.metadata.create_all(self.engine)
+    """对共享引擎上一个会话的轻量包装, 构造与关闭只涉及从连接池借还连接"""
+
+    def __init__(self, db_file_name: str = "documents.db", engine: Optional[sqlalchemy.Engine] = None):
+        self.engine = engine or get_engine(db_file_name)
         self.session = sqlmodel.Session(self.engine)
-        # 启用外键约束
-        self.session.connection().execute(sqlmodel.text("PRAGMA foreign_keys=ON"))
+        # 写入线程批量提交时置为 SAVEPOINT: 写方法的提交只落到保存点, 提交后的回调推迟到整批提交之后
+        self._savepoint: Optional[sqlalchemy.orm.SessionTransaction] = None
+        self._pending_callbacks: list[Callable[[], Any]] = []
 
     def __enter__(self):
         return self
@@ -55,12 +258,28 @@ class DocumentDB:
     # 构建builder
 
     @staticmethod
-    def query_all_documents() -> SelectOfScalar[document_sql.Document]:
+    def with_relations(statement: SelectOfScalar[document_sql.Document]) -> SelectOfScalar[document_sql.Document]:
+        """
+        让 Builder 预加载作者、标签与来源
+        selectinload 对每种关联额外发一条 IN 查询, 一页的查询数与页大小无关
+        """
+        return statement.options(
+            selectinload(document_sql.Document.authors),
+            selectinload(document_sql.Document.tags),
+            selectinload(document_sql.Document.sources)
+        )
+
+    @staticmethod
+    def query_all_documents(eager: bool = False) -> SelectOfScalar[document_sql.Document]:
         """返回查询所有文档的 Builder"""
-        return sqlmodel.select(document_sql.Document).order_by(sqlmodel.desc(document_sql.Document.document_id))
+        statement = sqlmodel.select(document_sql.Document).order_by(sqlmodel.desc(document_sql.Document.document_id))
+        if eager:
+            statement = DocumentDB.with_relations(statement)
+        return statement
 
     def query_by_tags(self, tags: List[int] | List[document_sql.Tag],
-                      match_all: bool = True) -> SelectOfScalar[document_sql.Document]:
+                      match_all: bool = True,
+                      eager: bool = False) -> SelectOfScalar[document_sql.Document]:
         tag_ids: set[int] = set()
         for tag_instance in tags:
             if isinstance(tag_instance, int):
@@ -68,7 +287,7 @@ class DocumentDB:
             if isinstance(tag_instance, document_sql.Tag):
                 tag_ids.add(tag_instance.id)
         if not tag_ids:
-            return self.query_all_documents()
+            return self.query_all_documents(eager)
         # 1. 基础 Join
         statement = (
             sqlmodel.select(document_sql.Document)
@@ -86,12 +305,15 @@ class DocumentDB:
         else:
             # OR 逻辑：去重即可
             statement = statement.distinct()
-        return statement.order_by(sqlmodel.desc(document_sql.Document.document_id))
+        statement = statement.order_by(sqlmodel.desc(document_sql.Document.document_id))
+        if eager:
+            statement = self.with_relations(statement)
+        return statement
 
-    def query_by_author(self, author_name: str) -> SelectOfScalar[document_sql.Document]:
+    def query_by_author(self, author_name: str, eager: bool = False) -> SelectOfScalar[document_sql.Document]:
         """返回按作者筛选的 Builder"""
         if not author_name:
-            return self.query_all_documents()
+            return self.query_all_documents(eager)
         stmt = (
             sqlmodel.select(document_sql.Document)
             .join(document_sql.DocumentAuthorLink)
@@ -99,20 +321,102 @@ class DocumentDB:
             .where(document_sql.Author.name == author_name)
             .order_by(sqlmodel.desc(document_sql.Document.document_id))
         )
+        if eager:
+            stmt = self.with_relations(stmt)
         return stmt
 
+    @staticmethod
+    def _like_any_fts_column(term: str):
+        """全文索引的 LIKE 版本: 标题、系列名或任一作者名包含 term"""
+        return sqlmodel.or_(
+            sqlmodel.col(document_sql.Document.title).contains(term, autoescape=True),
+            sqlmodel.col(document_sql.Document.series_name).contains(term, autoescape=True),
+            sqlmodel.col(document_sql.Document.document_id).in_(
+                sqlmodel.select(document_sql.DocumentAuthorLink.document_id)
+                .join(document_sql.Author)
+                .where(sqlmodel.col(document_sql.Author.name).contains(term, autoescape=True))))
+
+    def query_by_keyword(self, keyword: str, eager: bool = False,
+                         author_name: Optional[str] = None) -> SelectOfScalar[document_sql.Document]:
+        """
+        返回按关键词全文检索的 Builder, 在标题、系列名、作者名中查找, 按相关度排序
+        关键词过短无法走全文索引时退回 LIKE, 同样在标题、系列名、作者名中查找, 按 document_id 降序
+        给出 author_name 时只保留该作者的文档
+        """
+        fts_query = build_fts_query(keyword)
+        if fts_query is None:
+            statement = (sqlmodel.select(document_sql.Document)
+                         .where(self._like_any_fts_column(keyword.strip()))
+                         .order_by(sqlmodel.desc(document_sql.Document.document_id)))
+        else:
+            matched = (sqlalchemy.select(documents_fts.c.rowid.label('document_id'),
+                                         documents_fts.c.rank.label('rank'))
+                       .where(sqlalchemy.text('documents_fts MATCH :fts_query').bindparams(fts_query=fts_query))
+                       .subquery())
+            statement = (sqlmodel.select(document_sql.Document)
+                         .join(matched, document_sql.Document.document_id == matched.c.document_id)
+                         .order_by(matched.c.rank, sqlmodel.desc(document_sql.Document.document_id)))
+        if author_name:
+            statement = statement.where(sqlmodel.col(document_sql.Document.document_id).in_(
+                sqlmodel.select(document_sql.DocumentAuthorLink.document_id)
+                .join(document_sql.Author)
+                .where(document_sql.Author.name == author_name)))
+        if eager:
+            statement = self.with_relations(statement)
+        return statement
+
     # --- 新增: 通用分页执行器 ---
 
-    def paginate_query(self, statement: SelectOfScalar[document_sql.Document],
-                       page: int,
-                       page_size: int) -> tuple[int, Sequence[document_sql.Document]]:
+    def count_query(self, statement: SelectOfScalar[document_sql.Document]) -> int:
         """
-        接收一个 Builder，自动计算总数并返回当页数据
+        计算 Builder 的结果总数, 结果按语句文本缓存, 写库或超过 COUNT_CACHE_TTL 秒后失效
+        翻页时筛选条件不变, 不必每页都把整个结果集数一遍
         """
-        # 1. 计算总数 (Total Count)
+        cache_key = str(statement.compile(compile_kwargs={"literal_binds": True}))
+        cached = _count_cache.get(cache_key)
+        generation = get_catalog_generation()
+        now = time.monotonic()
+        if cached is not None and cached[0] == generation and now - cached[1] < COUNT_CACHE_TTL:
+            return cached[2]
         # 使用 select_from(statement.subquery()) 是最稳健的方法，能处理 distinct/join 等复杂情况
         count_stmt = sqlmodel.select(sqlmodel.func.count()).select_from(statement.subquery())
         total_count = self.session.exec(count_stmt).one()
+        if len(_count_cache) >= MAX_COUNT_CACHE_ENTRIES:
+            _count_cache.clear()
+        _count_cache[cache_key] = (generation, now, total_count)
+        return total_count
+
+    def paginate_keyset(self, statement: SelectOfScalar[document_sql.Document],
+                        cursor: Optional[int],
+                        page_size: int,
+                        with_count: bool = True,
+                        offset: int = 0) -> tuple[Optional[int], Sequence[document_sql.Document], Optional[int]]:
+        """
+        按 document_id 降序的游标分页, cursor 为上一页最后一个文档的 id
+        走主键范围扫描, 翻到多深的页都和第一页一样快; 按页码跳转时用 offset 跳过前面的页
+        返回 (总数, 当页数据, 下一页游标), 不需要总数时总数为 None, 没有下一页时游标为 None
+        """
+        total_count = self.count_query(statement) if with_count else None
+        paged_stmt = statement
+        if cursor is not None:
+            paged_stmt = paged_stmt.where(document_sql.Document.document_id < cursor)
+        # 多取一条用来判断是否还有下一页
+        results = self.session.exec(paged_stmt.offset(offset).limit(page_size + 1)).all()
+        next_cursor = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            next_cursor = results[-1].document_id
+        return total_count, results, next_cursor
+
+    def paginate_query(self, statement: SelectOfScalar[document_sql.Document],
+                       page: int,
+                       page_size: int,
+                       with_count: bool = True) -> tuple[Optional[int], Sequence[document_sql.Document]]:
+        """
+        接收一个 Builder，自动计算总数并返回当页数据, 不需要总数时总数为 None
+        """
+        # 1. 计算总数 (Total Count)
+        total_count = self.count_query(statement) if with_count else None
         # 2. 获取当页数据 (Pagination)
         offset_val = (page - 1) * page_size
         paginated_stmt = statement.offset(offset_val).limit(page_size)
@@ -135,9 +439,14 @@ class DocumentDB:
         if exact_match:
             statement = statement.where(document_sql.Document.title == name)
         else:
-            statement = statement.where(sqlmodel.col(document_sql.Document.title).contains(name))
+            statement = self.query_by_keyword(name)
         return self.session.exec(statement).all()
 
+    def get_keyword_document_ids(self, keyword: str) -> set[int]:
+        """关键词命中的全部文档 id, 供与标签索引的结果求交集"""
+        matched = self.query_by_keyword(keyword).subquery()
+        return set(self.session.exec(sqlmodel.select(matched.c.document_id)).all())
+
     def search_by_author(self, author_name: str) -> Sequence[document_sql.Document]:
         builder = self.query_by_author(author_name)
         return self.session.exec(builder).all()
@@ -151,6 +460,10 @@ class DocumentDB:
             statement = statement.where(document_sql.DocumentSourceLink.source_id == source_id)
         return self.session.exec(statement).first()
 
+    def get_source_document_ids(self, doc_id: int) -> Sequence[str]:
+        return self.session.exec(sqlmodel.select(document_sql.DocumentSourceLink.source_document_id)
+                                 .where(document_sql.DocumentSourceLink.document_id == doc_id)).all()
+
     def search_by_file(self, filename: Union[str, Path]) -> Optional[document_sql.Document]:
         fname = filename.name if isinstance(filename, Path) else filename
         statement = sqlmodel.select(document_sql.Document).where(document_sql.Document.file_path == fname)
@@ -159,6 +472,18 @@ class DocumentDB:
     def get_document_by_id(self, doc_id: int) -> Optional[document_sql.Document]:
         return self.session.get(document_sql.Document, doc_id)
 
+    def get_documents_by_ids(self, doc_ids: Iterable[int], eager: bool = False) -> Sequence[document_sql.Document]:
+        """按 id 批量取文档, 结果按 document_id 降序"""
+        doc_ids = list(doc_ids)
+        if not doc_ids:
+            return []
+        statement = (sqlmodel.select(document_sql.Document)
+                     .where(sqlmodel.col(document_sql.Document.document_id).in_(doc_ids))
+                     .order_by(sqlmodel.desc(document_sql.Document.document_id)))
+        if eager:
+            statement = self.with_relations(statement)
+        return self.session.exec(statement).all()
+
     def get_range_documents(self, count=10, target_page: Optional[int] = None):
         statement = sqlmodel.select(document_sql.Document).order_by(
             sqlmodel.desc(document_sql.Document.document_id)).limit(count)
@@ -180,35 +505,78 @@ class DocumentDB:
         tags = self.session.exec(sqlmodel.select(document_sql.Tag).where(document_sql.Tag.group_id == group_id)).all()
         return tags
 
+    def get_tag_ids_by_names(self, names: Iterable[str]) -> dict[str, int]:
+        """一次 IN 查询取回一组标签名对应的 id, 不存在的名字不在结果里"""
+        names = set(names)
+        if not names:
+            return {}
+        return dict(self.session.exec(
+            sqlmodel.select(document_sql.Tag.name, document_sql.Tag.tag_id)
+            .where(sqlmodel.col(document_sql.Tag.name).in_(names))).all())
+
     def get_tag_by_hitomi(self, hitomi_name: str) -> Optional[document_sql.Tag]:
-        try:
-            return self.session.exec(sqlmodel.select(document_sql.Tag).where(document_sql.Tag.hitomi_alter == hitomi_name)).one()
-        except NoResultFound:
-            return None
+        return self.resolve_hitomi_tags([hitomi_name]).get(hitomi_name)
+
+    def resolve_hitomi_tags(self, hitomi_names: Iterable[str]) -> dict[str, document_sql.Tag]:
+        """
+        批量把 hitomi 标签名映射到库中的标签, 未入库的名字不在结果里
+        走进程内字典, 返回的 Tag 不属于任何会话, 只应读取字段
+        """
+        return hitomi_tag_cache.resolve(self.session, hitomi_names)
 
     # --- 写入与修改方法 ---
 
+    # 批量模式下用保存点模拟提交与回滚: 提交即释放当前保存点, 回滚只撤销上次提交之后的改动,
+    # 两者之后都立即开启新的保存点, 语义与单独提交时一致, 只是真正落盘推迟到整批提交
+
+    def _commit(self):
+        if self._savepoint is None:
+            self.session.commit()
+            return
+        self.session.flush()
+        self._savepoint.commit()
+        self._savepoint = self.session.begin_nested()
+
+    def _rollback(self):
+        if self._savepoint is None:
+            self.session.rollback()
+            return
+        # flush 失败后保存点处于失效状态, 同样需要显式回滚才能继续使用会话
+        if self.session.get_nested_transaction() is self._savepoint:
+            self._savepoint.rollback()
+        self._savepoint = self.session.begin_nested()
+
+    def _on_commit(self, fn: Callable[..., Any], *args):
+        """数据真正提交后再更新内存索引与目录代数, 批量模式下整批提交失败时这些回调不会执行"""
+        if self._savepoint is None:
+            fn(*args)
+        else:
+            self._pending_callbacks.append(functools.partial(fn, *args))
+
     def add_source(self, name: str, base_url: Optional[str] = None) -> Optional[int]:
         try:
             source = document_sql.Source(name=name, base_url=base_url)
             self.session.add(source)
-            self.session.commit()
+            self._commit()
+            self._on_commit(bump_catalog_generation)
             self.session.refresh(source)
             return source.source_id
         except Exception as ie:
             print(ie)
-            self.session.rollback()
+            self._rollback()
             return None
 
     def add_tag(self, tag: document_sql.Tag) -> Optional[document_sql.Tag]:
         try:
             self.session.add(tag)
-            self.session.commit()
+            self._commit()
+            self._on_commit(bump_catalog_generation)
             self.session.refresh(tag)
+            self._on_commit(hitomi_tag_cache.put, tag)
             return tag
         except Exception as ie:
             print(ie)
-            self.session.rollback()
+            self._rollback()
             return None
 
     def add_document(self, title: str, filepath: Union[str, Path],
@@ -218,50 +586,97 @@ class DocumentDB:
                      source: Optional[dict] = None,  # {'source_id': int, 'source_document_id': str}
                      given_id: int = None,
                      check_file=True) -> int:
+        """单个文档的 add_documents, 文件或来源已存在时返回 -1"""
+        sources = [(source['source_id'], source['source_document_id'])] if source else ()
+        new_document = NewDocument(title, filepath, authors=tuple(authors or ()), sources=sources,
+                                   series=series, volume=volume, given_id=given_id)
+        doc_id = self.add_documents([new_document], check_file=check_file)[0]
+        return -1 if doc_id is None else doc_id
+
+    def add_documents(self, documents: Iterable[NewDocument], check_file=True) -> list[Optional[int]]:
+        """
+        批量录入文档及其作者、标签、来源, 全部在一个事务里提交
+        作者用 INSERT ... ON CONFLICT DO NOTHING 加 IN 查询一次性解析, 关联表按批插入
+        返回与输入顺序一致的文档 id; 文件或来源已在库中 (或与同批前面的文档重复) 的文档跳过, 对应位置为 None
+        """
+        documents = list(documents)
+        for document in documents:
+            # 验证
+            if document.series and not document.volume:
+                raise ValueError('添加系列后必须添加卷')
+            if document.volume and not str(document.volume).isdigit():
+                raise ValueError('卷号必须为数字')
+            if check_file and not os.path.exists(document.filepath):
+                raise FileNotFoundError(f'{document.filepath} 未找到')
+        file_paths = [os.path.basename(document.filepath) for document in documents]
+        source_keys = {source_document_id for document in documents for _, source_document_id in document.sources}
+        seen_files = set(self.session.exec(
+            sqlmodel.select(document_sql.Document.file_path)
+            .where(sqlmodel.col(document_sql.Document.file_path).in_(set(file_paths)))).all())
+        seen_sources = set(self.session.exec(
+            sqlmodel.select(document_sql.DocumentSourceLink.source_document_id)
+            .where(sqlmodel.col(document_sql.DocumentSourceLink.source_document_id).in_(source_keys)))
+                           .all()) if source_keys else set()
+        accepted: list[int] = []
+        for pos, (document, file_path) in enumerate(zip(documents, file_paths)):
+            keys = [source_document_id for _, source_document_id in document.sources]
+            if file_path in seen_files or any(key in seen_sources for key in keys):
+                continue
+            seen_files.add(file_path)
+            seen_sources.update(keys)
+            accepted.append(pos)
+        results: list[Optional[int]] = [None] * len(documents)
+        if not accepted:
+            return results
 
-        # 验证
-        if series and not volume:
-            raise ValueError('添加系列后必须添加卷')
-        if volume and not str(volume).isdigit():
-            raise ValueError('卷号必须为数字')
-
-        filepath_str = os.path.basename(filepath)
-        if check_file and not os.path.exists(filepath):
-            raise FileNotFoundError(f'{filepath} 未找到')
-
-        doc = document_sql.Document(
-            document_id=given_id,
-            title=title,
-            file_path=filepath_str,
-            series_name=series,
-            volume_number=volume
-        )
-        self.session.add(doc)
-        self.session.commit()
-        self.session.refresh(doc)  # 获取生成的 ID
-
-        # 处理作者
-        if authors:
-            for author_name in authors:
-                # 查找或创建作者
-                auth = self.session.exec(
-                    sqlmodel.select(document_sql.Author).where(document_sql.Author.name == author_name)).first()
-                if not auth:
-                    auth = document_sql.Author(name=author_name)
-                    self.session.add(auth)
-                    self.session.commit()
-                    self.session.refresh(auth)
-
-                # 建立关联
-                link = document_sql.DocumentAuthorLink(document_id=doc.document_id, author_id=auth.author_id)
-                self.session.add(link)
-
-        # 处理来源
-        if source:
-            self.link_document_source(doc.document_id, source['source_id'], source['source_document_id'])
-
-        self.session.commit()
-        return doc.document_id
+        try:
+            # 作者: 不存在的一次插入, 再一次查回全部 id
+            author_names = {name for pos in accepted for name in documents[pos].authors}
+            author_ids: dict[str, int] = {}
+            if author_names:
+                self.session.execute(
+                    sqlite_insert(document_sql.Author).on_conflict_do_nothing(index_elements=['name']),
+                    [{'name': name} for name in author_names])
+                author_ids = dict(self.session.exec(
+                    sqlmodel.select(document_sql.Author.name, document_sql.Author.author_id)
+                    .where(sqlmodel.col(document_sql.Author.name).in_(author_names))).all())
+
+            new_ids = self.session.scalars(
+                sqlalchemy.insert(document_sql.Document).returning(document_sql.Document.document_id,
+                                                                   sort_by_parameter_order=True),
+                [{'document_id': documents[pos].given_id,
+                  'title': documents[pos].title,
+                  'file_path': file_paths[pos],
+                  'series_name': documents[pos].series,
+                  'volume_number': documents[pos].volume} for pos in accepted]).all()
+
+            author_links, tag_links, source_links = [], [], []
+            for pos, doc_id in zip(accepted, new_ids):
+                document = documents[pos]
+                results[pos] = doc_id
+                for author_id in {author_ids[name] for name in document.authors}:
+                    author_links.append({'document_id': doc_id, 'author_id': author_id})
+                for tag_id in {tag if isinstance(tag, int) else tag.tag_id for tag in document.tags}:
+                    tag_links.append({'document_id': doc_id, 'tag_id': tag_id})
+                for source_id, source_document_id in document.sources:
+                    source_links.append({'document_id': doc_id, 'source_id': source_id,
+                                         'source_document_id': source_document_id})
+            for link_model, rows in ((document_sql.DocumentAuthorLink, author_links),
+                                     (document_sql.DocumentTagLink, tag_links),
+                                     (document_sql.DocumentSourceLink, source_links)):
+                if rows:
+                    self.session.execute(sqlite_insert(link_model).on_conflict_do_nothing(), rows)
+            self._commit()
+        except Exception:
+            self._rollback()
+            raise
+
+        self._on_commit(bump_catalog_generation)
+        for doc_id in new_ids:
+            self._on_commit(tag_index.add_document, doc_id)
+        for link in tag_links:
+            self._on_commit(tag_index.add_link, link['document_id'], link['tag_id'])
+        return results
 
     def edit_document(self, doc_id: int,
                       title: Optional[str] = None,
@@ -303,7 +718,7 @@ class DocumentDB:
                 if not auth:
                     auth = document_sql.Author(name=author_name)
                     self.session.add(auth)
-                    self.session.commit()
+                    self._commit()
                     self.session.refresh(auth)
 
                 new_link = document_sql.DocumentAuthorLink(document_id=doc_id, author_id=auth.author_id)
@@ -311,10 +726,11 @@ class DocumentDB:
 
         try:
             self.session.add(doc)
-            self.session.commit()
+            self._commit()
+            self._on_commit(bump_catalog_generation)
             return 0
         except Exception as e:
-            self.session.rollback()
+            self._rollback()
             print(e)
             return -5
 
@@ -322,7 +738,9 @@ class DocumentDB:
         doc = self.session.get(document_sql.Document, doc_id)
         if doc:
             self.session.delete(doc)
-            self.session.commit()
+            self._commit()
+            self._on_commit(bump_catalog_generation)
+            self._on_commit(tag_index.remove_document, doc_id)
             return 0
         return -1
 
@@ -331,11 +749,12 @@ class DocumentDB:
             link = document_sql.DocumentSourceLink(document_id=doc_id, source_id=source_id,
                                                    source_document_id=source_document_id)
             self.session.add(link)
-            self.session.commit()
+            self._commit()
+            self._on_commit(bump_catalog_generation)
             return True
         except Exception as ie:
             print(ie)
-            self.session.rollback()
+            self._rollback()
             return False
 
     def link_document_tag(self, doc_id: int, tag: int | document_sql.Tag) -> bool:
@@ -346,13 +765,76 @@ class DocumentDB:
                 tag_id = tag.tag_id
             link = document_sql.DocumentTagLink(document_id=doc_id, tag_id=tag_id)
             self.session.merge(link)
-            self.session.commit()
+            self._commit()
+            self._on_commit(bump_catalog_generation)
+            self._on_commit(tag_index.add_link, doc_id, tag_id)
             return True
         except Exception as e:
             print(e)
-            self.session.rollback()
+            self._rollback()
             return False
 
+    # 下载任务队列, 状态含义见 document_sql.DownloadJob
+
+    def enqueue_download_job(self, source_id: int, source_document_id: str, title: str,
+                             tag_ids: Iterable[int] = ()) -> document_sql.DownloadJob:
+        """同一来源的同一本已在排队或运行时直接返回已有任务, 已结束的任务重新排队"""
+        job = self.session.exec(sqlmodel.select(document_sql.DownloadJob).where(
+            document_sql.DownloadJob.source_id == source_id,
+            document_sql.DownloadJob.source_document_id == source_document_id)).first()
+        if job is not None and job.state in ('queued', 'running', 'retry'):
+            return job
+        if job is None:
+            job = document_sql.DownloadJob(source_id=source_id, source_document_id=source_document_id, title=title)
+        job.title = title
+        job.tag_ids = ','.join(str(tag_id) for tag_id in tag_ids)
+        job.state = 'queued'
+        job.attempts = 0
+        job.next_attempt_at = 0
+        job.message = None
+        job.updated_at = time.time()
+        self.session.add(job)
+        self._commit()
+        self.session.refresh(job)
+        return job
+
+    def claim_download_jobs(self, limit: int, now: float) -> list[document_sql.DownloadJob]:
+        """取出最多 limit 个可以开始的任务并标记为 running"""
+        jobs = self.session.exec(sqlmodel.select(document_sql.DownloadJob).where(
+            sqlmodel.col(document_sql.DownloadJob.state).in_(('queued', 'retry')),
+            document_sql.DownloadJob.next_attempt_at <= now
+        ).order_by(document_sql.DownloadJob.job_id).limit(limit)).all()
+        for job in jobs:
+            job.state = 'running'
+            job.updated_at = now
+        self._commit()
+        return list(jobs)
+
+    def finish_download_job(self, job_id: int, state: str, attempts: int,
+                            message: Optional[str] = None, next_attempt_at: float = 0):
+        job = self.session.get(document_sql.DownloadJob, job_id)
+        if job is None:
+            return
+        job.state = state
+        job.attempts = attempts
+        job.message = message
+        job.next_attempt_at = next_attempt_at
+        job.updated_at = time.time()
+        self._commit()
+
+    def requeue_running_download_jobs(self) -> int:
+        """进程退出时仍在运行的任务重新排队, 返回数量"""
+        result = self.session.execute(sqlalchemy.update(document_sql.DownloadJob)
+                                   .where(document_sql.DownloadJob.state == 'running')
+                                   .values(state='queued', updated_at=time.time()))
+        self._commit()
+        return result.rowcount
+
+    def get_download_jobs(self, states: Iterable[str]) -> Sequence[document_sql.DownloadJob]:
+        return self.session.exec(sqlmodel.select(document_sql.DownloadJob)
+                                 .where(sqlmodel.col(document_sql.DownloadJob.state).in_(tuple(states)))
+                                 .order_by(document_sql.DownloadJob.job_id)).all()
+
     def get_wandering_files(self, base_path: Union[str, Path]) -> set[Path]:
         base_path = Path(base_path)
         if not base_path.exists():
@@ -370,6 +852,225 @@ class DocumentDB:
         return wandering_files
 
 
+# ==========================================
+# 异步外观: 协程里的数据库调用统一丢到专用线程池, 事件循环不会被 SQLite 卡住
+# ==========================================
+
+# 专用线程池的大小, 同时也限制了异步路径上并发占用的连接数
+DB_WORKERS = int(os.environ.get('DB_WORKERS', 4))
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_executor_lock = threading.Lock()
+T = TypeVar('T')
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    with _db_executor_lock:
+        if _db_executor is None:
+            _db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='document_db')
+        return _db_executor
+
+
+def shutdown_db_executor():
+    global _db_executor
+    with _db_executor_lock:
+        executor, _db_executor = _db_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+# ==========================================
+# 单写入线程: 所有写操作排队, 由同一个连接分批提交
+# ==========================================
+
+# 一批最多合并多少个写操作
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', 64))
+
+
+class _WriteOp(NamedTuple):
+    fn: Callable[['DocumentDB'], Any]
+    future: Future
+
+
+class DocumentWriter:
+    """
+    写操作串行化: 调用方提交 fn(db), 写入线程把队列里积压的操作合成一个事务提交 (group commit)
+    每个操作包在自己的 SAVEPOINT 里, 单个操作失败只回滚它自己, 不影响同批的其他操作
+    同一进程内不再有多个连接争抢写锁, 读连接在 WAL 下也不会被写入阻塞
+    """
+
+    def __init__(self, db_file_name: str = "documents.db", batch_size: int = WRITE_BATCH_SIZE):
+        self.db_file_name = db_file_name
+        self.batch_size = batch_size
+        self._queue: queue.SimpleQueue[Optional[_WriteOp]] = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> 'Future[T]':
+        """排队执行 fn(db, *args, **kwargs), 返回的 Future 在所在批次提交后才完成"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='document_writer', daemon=True)
+                self._thread.start()
+        future: Future = Future()
+        self._queue.put(_WriteOp(lambda db: fn(db, *args, **kwargs), future))
+        return future
+
+    def call(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """同步代码用: 提交并等待结果"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """协程用: 提交并 await 结果"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _run(self):
+        db = DocumentDB(self.db_file_name, engine=create_writer_engine(self.db_file_name))
+        # 结果会交给其他线程使用, 提交后不能过期, 否则访问属性会在别的线程里用这个会话重新查询
+        db.session.expire_on_commit = False
+        while True:
+            op = self._queue.get()
+            if op is None:
+                break
+            batch = [op]
+            # 不额外等待, 只把已经积压的操作并进同一批
+            while len(batch) < self.batch_size:
+                try:
+                    op = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if op is None:
+                    self._queue.put(None)
+                    break
+                batch.append(op)
+            self._run_batch(db, batch)
+        db.session.close()
+        db.engine.dispose()
+
+    @staticmethod
+    def _run_op(db: 'DocumentDB', op: _WriteOp) -> tuple[bool, Any]:
+        db._pending_callbacks = []
+        db._savepoint = db.session.begin_nested()
+        try:
+            result = op.fn(db)
+            db._commit()
+            return True, result
+        except BaseException as e:
+            # 与单独提交时一样: 之前已提交的部分保留, 只撤销最后一次提交之后的改动
+            db._rollback()
+            return False, e
+        finally:
+            db._savepoint.rollback()
+            db._savepoint = None
+
+    def _run_batch(self, db: 'DocumentDB', batch: list[_WriteOp]):
+        done: list[tuple[Future, bool, Any, list[Callable[[], Any]]]] = []
+        try:
+            for op in batch:
+                if not op.future.set_running_or_notify_cancel():
+                    continue
+                ok, result = self._run_op(db, op)
+                done.append((op.future, ok, result, db._pending_callbacks))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for future, _, _, _ in done:
+                future.set_exception(e)
+            return
+        finally:
+            db._pending_callbacks = []
+            db.session.expunge_all()
+        self.batches += 1
+        self.operations += len(done)
+        for future, ok, result, callbacks in done:
+            for callback in callbacks:
+                callback()
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def shutdown(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+_writers: dict[str, DocumentWriter] = {}
+
+
+def get_writer(db_file_name: str = "documents.db") -> DocumentWriter:
+    with _engines_lock:
+        writer = _writers.get(db_file_name)
+        if writer is None:
+            writer = _writers[db_file_name] = DocumentWriter(db_file_name)
+        return writer
+
+
+def shutdown_writers():
+    with _engines_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.shutdown()
+
+
+# DocumentDB 中会写库的方法, 通过 AsyncDocumentDB 调用时转交写入线程
+WRITE_METHODS = frozenset({'add_source', 'add_tag', 'add_document', 'edit_document', 'delete_document',
+                           'link_document_source', 'link_document_tag', 'enqueue_download_job',
+                           'claim_download_jobs', 'finish_download_job', 'requeue_running_download_jobs'})
+
+
+class AsyncDocumentDB:
+    """
+    DocumentDB 的异步包装, DocumentDB 的方法都可以直接 await 调用:
+        async with AsyncDocumentDB() as db:
+            doc = await db.search_by_source('123')
+    读操作在线程池中用本实例的会话执行, 同一实例上的调用按顺序进行;
+    写方法 (WRITE_METHODS) 与 write() 交给单写入线程, 与其他写操作一起分批提交
+    """
+
+    def __init__(self, db_file_name: str = "documents.db"):
+        self.db_file_name = db_file_name
+        self.db: Optional[DocumentDB] = None
+        self._lock = asyncio.Lock()
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """在线程池中执行 fn(db, *args, **kwargs), 适合需要连续做几次查询的逻辑"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_db_executor(),
+                                              functools.partial(fn, self.db, *args, **kwargs))
+
+    async def write(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """交给写入线程执行 fn(writer_db, *args, **kwargs)"""
+        return await get_writer(self.db_file_name).run(fn, *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        method = getattr(DocumentDB, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            if name in WRITE_METHODS:
+                return await self.write(lambda db: getattr(db, name)(*args, **kwargs))
+            return await self.run(lambda db: getattr(db, name)(*args, **kwargs))
+
+        return call
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        self.db = await loop.run_in_executor(get_db_executor(), DocumentDB, self.db_file_name)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(get_db_executor(), self.db.session.close)
+
+
 # ==========================================
 # 独立的维护逻辑 (CLI Operations)
 # ==========================================
@@ -460,9 +1161,131 @@ async def update_hitomi_file_hash(hitomi_id_list: list[int], idb: DocumentDB):
             temp_file_path.unlink(missing_ok=True)
 
 
+def bench_session_overhead(db_file_name: str = "documents.db", rounds: int = 200):
+    """对比每次请求新建引擎 (旧做法) 与从共享连接池取会话的开销, 每轮执行同一条简单查询"""
+    probe = sqlmodel.select(sqlmodel.func.count()).select_from(document_sql.Document)
+
+    def per_request_engine():
+        engine = sqlmodel.create_engine(f"sqlite:///{db_file_name}")
+        setup_schema(engine)
+        with sqlmodel.Session(engine) as session:
+            session.connection().execute(sqlmodel.text("PRAGMA foreign_keys=ON"))
+            session.exec(probe).one()
+        engine.dispose()
+
+    def pooled_session():
+        with DocumentDB(db_file_name) as idb:
+            idb.session.exec(probe).one()
+
+    get_engine(db_file_name)
+    for label, fn in (('新建引擎', per_request_engine), ('共享连接池', pooled_session)):
+        fn()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"{label}: {elapsed / rounds * 1000:.3f} ms/请求 ({rounds} 轮)")
+
+
+def stress_writer(ingest_workers: int = 8, docs_per_worker: int = 200, read_workers: int = 4) -> dict[str, Any]:
+    """
+    在临时库上压测写入线程: 多个线程并发录入 (文档 + 作者 + 标签 + 来源), 同时有线程持续分页读取
+    输出录入与读取吞吐, 平均每批合并的操作数, 以及失败次数 (应当为 0, 不再出现 database is locked)
+    返回写入批次数, 操作数, 读取次数与捕获到的异常
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = str(Path(temp_dir) / 'stress.db')
+        writer = DocumentWriter(db_file)
+        source_id = writer.call(DocumentDB.add_source, 'stress')
+        group = writer.call(lambda idb: idb.session.merge(document_sql.TagGroup(group_name='stress')))
+        tag_ids = [writer.call(DocumentDB.add_tag, document_sql.Tag(name=f'stress_{i}', group_id=group.tag_group_id)).tag_id
+                   for i in range(16)]
+        stop = threading.Event()
+        errors: list[BaseException] = []
+        reads = [0] * read_workers
+
+        def ingest(worker_no: int):
+            def write_document(idb: DocumentDB, n: int) -> int:
+                new_id = idb.add_document(f'stress {worker_no}-{n}', f'{worker_no}_{n}.zip',
+                                          authors=[f'author {n % 50}'], check_file=False,
+                                          source={'source_id': source_id, 'source_document_id': f'{worker_no}-{n}'})
+                for tag_id in tag_ids[n % 4::4]:
+                    idb.link_document_tag(new_id, tag_id)
+                return new_id
+
+            for n in range(docs_per_worker):
+                try:
+                    writer.call(write_document, n)
+                except Exception as e:
+                    errors.append(e)
+
+        def read(worker_no: int):
+            while not stop.is_set():
+                try:
+                    with DocumentDB(db_file) as idb:
+                        idb.paginate_query(idb.query_by_tags(tag_ids[:2], eager=True), 1, 20)
+                    reads[worker_no] += 1
+                except Exception as e:
+                    errors.append(e)
+
+        readers = [threading.Thread(target=read, args=(i,)) for i in range(read_workers)]
+        ingesters = [threading.Thread(target=ingest, args=(i,)) for i in range(ingest_workers)]
+        start = time.perf_counter()
+        for thread in readers + ingesters:
+            thread.start()
+        for thread in ingesters:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for thread in readers:
+            thread.join()
+        writer.shutdown()
+        total_docs = ingest_workers * docs_per_worker
+        print(f"录入 {total_docs} 个文档, 用时 {elapsed:.2f}s, {total_docs / elapsed:.1f} 文档/秒")
+        print(f"同期读取 {sum(reads)} 次, {sum(reads) / elapsed:.1f} 次/秒")
+        print(f"写入批次 {writer.batches}, 平均每批 {writer.operations / max(writer.batches, 1):.2f} 个操作")
+        print(f"失败 {len(errors)} 次" + (f", 首个异常: {errors[0]!r}" if errors else ""))
+        return {'batches': writer.batches, 'operations': writer.operations, 'reads': sum(reads), 'errors': errors}
+
+
+def generate_all_thumbnails(idb: DocumentDB, force: bool = False):
+    """为整个文库补全缩略图, 已有全部尺寸的文档直接跳过, 中断后重跑即可续上"""
+    from concurrent.futures import as_completed
+    from tqdm import tqdm
+    import thumbnail
+
+    pending: list[tuple[int, Path]] = []
+    for doc in idb.get_all_document_ids():
+        if not force and thumbnail.has_thumbnails(doc.document_id):
+            continue
+        archive_path = archived_document_path / doc.file_path
+        if not archive_path.exists():
+            print(f'文档 {doc.document_id} 的文件 {doc.file_path} 不存在，跳过')
+            continue
+        pending.append((doc.document_id, archive_path))
+    if not pending:
+        print('所有文档均已有缩略图')
+        return
+    executor = thumbnail.get_executor()
+    futures = {executor.submit(thumbnail.render_thumbnails, doc_id, archive_path): doc_id
+               for doc_id, archive_path in pending}
+    failed: list[int] = []
+    try:
+        for future in tqdm(as_completed(futures), total=len(futures), desc='生成缩略图'):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                tqdm.write(f'文档 {futures[future]} 缩略图生成失败: {e}')
+    finally:
+        thumbnail.shutdown_executor()
+    print(f'完成 {len(pending) - len(failed)} 个，失败 {len(failed)} 个')
+
+
 if __name__ == '__main__':
     if len(sys.argv) <= 1:
-        print('Usage: python Document_DB.py [clean|fix_hash|hitomi_update|test] [args...]')
+        print('Usage: python Document_DB.py [clean|fix_hash|hitomi_update|thumbnails|bench|stress|test] [args...]')
         sys.exit(1)
 
     cmd_g = sys.argv[1]
@@ -492,6 +1315,18 @@ if __name__ == '__main__':
             except (IndexError, ValueError):
                 print("Invalid Hitomi ID")
 
+        elif cmd_g == 'thumbnails':
+            # 加 --force 则重新生成已有的缩略图
+            generate_all_thumbnails(db_g, force='--force' in sys.argv[2:])
+
+        elif cmd_g == 'bench':
+            # 可选参数为轮数
+            bench_session_overhead(rounds=int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+
+        elif cmd_g == 'stress':
+            # 可选参数为 录入线程数 每线程文档数 读线程数
+            stress_writer(*(int(arg) for arg in sys.argv[2:5]))
+
         elif cmd_g == 'test':
             # 简单的测试逻辑
             cnt_g = len(db_g.get_all_document_ids())
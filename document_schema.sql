@@ -79,6 +79,9 @@ CREATE TABLE IF NOT EXISTS tags (
     FOREIGN KEY (group_id) REFERENCES tag_groups (tag_group_id)
 );
 
+-- 录入时按 hitomi 标签名反查
+CREATE INDEX IF NOT EXISTS idx_tags_hitomi_alter ON tags (hitomi_alter);
+
 CREATE TABLE IF NOT EXISTS document_tags (
     document_id INTEGER NOT NULL,
     tag_id   INTEGER NOT NULL,
@@ -88,4 +91,87 @@ CREATE TABLE IF NOT EXISTS document_tags (
 );
 
 -- 为 document_tags 表中的 tag_id 创建索引，以优化反向查询（例如：查询使用某标签的所有文献）
-CREATE INDEX IF NOT EXISTS idx_document_tags_tag_id ON document_tags (tag_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_document_tags_tag_id ON document_tags (tag_id);
+
+-- ----------------------------
+-- 全文检索: 标题、系列名与作者名, trigram 分词以支持中日文子串检索
+-- 行号与 documents.document_id 一致, 由下列触发器保持同步
+-- ----------------------------
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(title, series_name, authors, tokenize='trigram');
+
+CREATE TRIGGER IF NOT EXISTS documents_fts_ai AFTER INSERT ON documents BEGIN
+    DELETE FROM documents_fts WHERE rowid = NEW.document_id;
+    INSERT INTO documents_fts (rowid, title, series_name, authors)
+    SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+           coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da
+                     JOIN authors a ON a.author_id = da.author_id
+                     WHERE da.document_id = d.document_id), '')
+    FROM documents d WHERE d.document_id = NEW.document_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS documents_fts_au AFTER UPDATE OF title, series_name ON documents BEGIN
+    DELETE FROM documents_fts WHERE rowid = NEW.document_id;
+    INSERT INTO documents_fts (rowid, title, series_name, authors)
+    SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+           coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da
+                     JOIN authors a ON a.author_id = da.author_id
+                     WHERE da.document_id = d.document_id), '')
+    FROM documents d WHERE d.document_id = NEW.document_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS documents_fts_ad AFTER DELETE ON documents BEGIN
+    DELETE FROM documents_fts WHERE rowid = OLD.document_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS documents_fts_dai AFTER INSERT ON document_authors BEGIN
+    DELETE FROM documents_fts WHERE rowid = NEW.document_id;
+    INSERT INTO documents_fts (rowid, title, series_name, authors)
+    SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+           coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da
+                     JOIN authors a ON a.author_id = da.author_id
+                     WHERE da.document_id = d.document_id), '')
+    FROM documents d WHERE d.document_id = NEW.document_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS documents_fts_dad AFTER DELETE ON document_authors BEGIN
+    DELETE FROM documents_fts WHERE rowid = OLD.document_id;
+    INSERT INTO documents_fts (rowid, title, series_name, authors)
+    SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+           coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da
+                     JOIN authors a ON a.author_id = da.author_id
+                     WHERE da.document_id = d.document_id), '')
+    FROM documents d WHERE d.document_id = OLD.document_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS documents_fts_aau AFTER UPDATE OF name ON authors BEGIN
+    DELETE FROM documents_fts WHERE rowid IN
+        (SELECT document_id FROM document_authors WHERE author_id = NEW.author_id);
+    INSERT INTO documents_fts (rowid, title, series_name, authors)
+    SELECT d.document_id, d.title, coalesce(d.series_name, ''),
+           coalesce((SELECT group_concat(a.name, ' ') FROM document_authors da2
+                     JOIN authors a ON a.author_id = da2.author_id
+                     WHERE da2.document_id = d.document_id), '')
+    FROM documents d
+    WHERE d.document_id IN (SELECT document_id FROM document_authors WHERE author_id = NEW.author_id);
+END;
+
+-- ----------------------------
+-- Table structure for download_jobs
+-- 持久化的下载任务队列, 进程重启后继续执行未完成的任务
+-- ----------------------------
+CREATE TABLE IF NOT EXISTS download_jobs (
+    job_id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    source_id          INTEGER NOT NULL,
+    source_document_id TEXT    NOT NULL,
+    title              TEXT    NOT NULL,
+    tag_ids            TEXT    NOT NULL DEFAULT '', -- 逗号分隔的标签 id
+    state              TEXT    NOT NULL DEFAULT 'queued', -- queued / running / retry / done / failed
+    attempts           INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at    REAL    NOT NULL DEFAULT 0,
+    message            TEXT,
+    updated_at         REAL    NOT NULL DEFAULT 0,
+    UNIQUE (source_id, source_document_id),
+    FOREIGN KEY (source_id) REFERENCES sources (source_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_download_jobs_state ON download_jobs (state, next_attempt_at);
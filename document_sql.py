@@ -1,5 +1,5 @@
 from typing import Optional, List
-from sqlmodel import Field, SQLModel, Relationship, Index
+from sqlmodel import Field, SQLModel, Relationship, Index, UniqueConstraint
 
 
 # ==========================================
@@ -113,6 +113,11 @@ class TagGroup(SQLModel, table=True):
 class Tag(SQLModel, table=True):
     __tablename__ = "tags"
 
+    # 录入时按 hitomi 标签名反查
+    __table_args__ = (
+        Index("idx_tags_hitomi_alter", "hitomi_alter"),
+    )
+
     tag_id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(unique=True)
     hitomi_alter: Optional[str] = None
@@ -157,3 +162,31 @@ class Document(SQLModel, table=True):
     sources: List[Source] = Relationship(
         back_populates="documents", link_model=DocumentSourceLink
     )
+
+
+# ==========================================
+# 下载任务队列 (与文献目录无关, 只是共用数据库文件)
+# ==========================================
+
+class DownloadJob(SQLModel, table=True):
+    __tablename__ = "download_jobs"
+
+    # 同一来源的同一本只保留一个任务; 调度器按状态和下次尝试时间取任务
+    __table_args__ = (
+        UniqueConstraint("source_id", "source_document_id"),
+        Index("idx_download_jobs_state", "state", "next_attempt_at"),
+    )
+
+    job_id: Optional[int] = Field(default=None, primary_key=True)
+    source_id: int = Field(foreign_key="sources.source_id", ondelete='CASCADE')
+    source_document_id: str
+    title: str
+    # 录入时关联的标签 id, 逗号分隔
+    tag_ids: str = ''
+    # queued / running / retry / done / failed
+    state: str = 'queued'
+    attempts: int = 0
+    # unix 时间戳, retry 状态的任务在此之后才会被再次调度
+    next_attempt_at: float = 0
+    message: Optional[str] = None
+    updated_at: float = 0
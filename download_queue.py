@@ -0,0 +1,116 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable
+import document_db
+import document_sql
+from document_db import DocumentDB
+from shared import task_status, update_task_status
+
+# 同时执行的下载任务数
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 2))
+# 单个任务最多尝试的次数, 用完后标记为 failed 等待人工处理
+DOWNLOAD_MAX_ATTEMPTS = int(os.environ.get('DOWNLOAD_MAX_ATTEMPTS', 5))
+# 第 n 次失败后等待 DOWNLOAD_RETRY_BASE * 2^(n-1) 秒再试, 不超过 DOWNLOAD_RETRY_MAX
+DOWNLOAD_RETRY_BASE = float(os.environ.get('DOWNLOAD_RETRY_BASE', 30))
+DOWNLOAD_RETRY_MAX = float(os.environ.get('DOWNLOAD_RETRY_MAX', 3600))
+# 没有新任务提醒时, 最多隔这么久检查一次到期的重试
+DOWNLOAD_POLL_INTERVAL = 5
+
+ACTIVE_STATES = ('queued', 'running', 'retry')
+
+
+class JobAbort(Exception):
+    """重试也不会改变结果的失败 (例如文件已在库中), 任务直接标记为 failed"""
+
+
+def retry_delay(attempts: int) -> float:
+    return min(DOWNLOAD_RETRY_BASE * 2 ** (attempts - 1), DOWNLOAD_RETRY_MAX)
+
+
+def job_key(job: document_sql.DownloadJob) -> str:
+    # task_status 以来源 id 为键, 同名的两本不会互相覆盖
+    return job.source_document_id
+
+
+class DownloadQueue:
+    """
+    持久化在 download_jobs 表中的下载任务队列
+    调度器最多同时运行 workers 个任务, 失败的任务按指数退避重试,
+    进程重启后把上次仍在运行的任务重新排队, handler 负责复用 raw_document 中已有的文件
+    """
+
+    def __init__(self, handler: Callable[[document_sql.DownloadJob], Awaitable[None]],
+                 workers: int = DOWNLOAD_WORKERS, max_attempts: int = DOWNLOAD_MAX_ATTEMPTS):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._wake = asyncio.Event()
+        self._running: dict[int, asyncio.Task] = {}
+
+    async def enqueue(self, source_id: int, source_document_id: str, title: str,
+                      tag_ids: list[int]) -> document_sql.DownloadJob:
+        """同一本已在队列中时返回已有的任务, 不会重复下载"""
+        job = await document_db.get_writer().run(DocumentDB.enqueue_download_job,
+                                                 source_id, source_document_id, title, tag_ids)
+        if job_key(job) not in task_status or job.state == 'queued':
+            update_task_status(job_key(job), title=job.title, percent=0, message=None)
+        self._wake.set()
+        return job
+
+    async def run(self):
+        # Event 绑定首次使用它的事件循环, 每次启动调度器都重新创建
+        self._wake = asyncio.Event()
+        writer = document_db.get_writer()
+        requeued = await writer.run(DocumentDB.requeue_running_download_jobs)
+        if requeued:
+            print(f'{requeued} 个未完成的下载任务重新排队')
+        async with document_db.AsyncDocumentDB() as db:
+            for job in await db.get_download_jobs(ACTIVE_STATES):
+                update_task_status(job_key(job), title=job.title, percent=0, message=job.message)
+        try:
+            while True:
+                # 先清除再取任务, 取任务期间到来的提醒不会丢失
+                self._wake.clear()
+                free_slots = self.workers - len(self._running)
+                if free_slots > 0:
+                    for job in await writer.run(DocumentDB.claim_download_jobs, free_slots, time.time()):
+                        self._running[job.job_id] = asyncio.create_task(self._run_job(job))
+                try:
+                    await asyncio.wait_for(self._wake.wait(), DOWNLOAD_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # 被取消的任务在库里仍是 running, 下次启动时重新排队
+            for task in self._running.values():
+                task.cancel()
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+    async def _run_job(self, job: document_sql.DownloadJob):
+        key = job_key(job)
+        update_task_status(key, title=job.title, message=None)
+        attempts = job.attempts + 1
+        state, message, next_attempt_at = 'done', None, 0.0
+        try:
+            await self.handler(job)
+        except JobAbort as e:
+            state, message = 'failed', str(e)
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                state, message = 'failed', f'下载失败, 已尝试 {attempts} 次: {e}'
+            else:
+                delay = retry_delay(attempts)
+                state, message = 'retry', f'下载失败, {round(delay)} 秒后重试: {e}'
+                next_attempt_at = time.time() + delay
+        finally:
+            self._running.pop(job.job_id, None)
+            self._wake.set()
+        try:
+            await document_db.get_writer().run(DocumentDB.finish_download_job, job.job_id, state, attempts,
+                                               message, next_attempt_at)
+        except Exception as e:
+            print(f'任务 {key} 状态写入失败: {e}')
+        if message is not None:
+            update_task_status(key, message=message)
+        elif state == 'done':
+            update_task_status(key, percent=100)
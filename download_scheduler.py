@@ -0,0 +1,183 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterable, TypeVar
+
+# 所有下载任务合计同时发起的请求数, 经过同一个代理, 超过上游的容忍度就会被限流
+DOWNLOAD_CONNECTIONS = int(os.environ.get('DOWNLOAD_CONNECTIONS', 8))
+# 合计带宽上限 (字节/秒), 0 表示不限
+DOWNLOAD_BANDWIDTH = int(os.environ.get('DOWNLOAD_BANDWIDTH', 0))
+# 令牌桶容量, 允许短时间内超出平均速率的量
+DOWNLOAD_BURST = int(os.environ.get('DOWNLOAD_BURST', 4 * 1024 * 1024))
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class TokenBucket:
+    """
+    按字节计的令牌桶: 请求完成后按实际大小扣除令牌, 余额可以为负;
+    新请求开始前要等余额回到非负, 事先不需要知道响应有多大
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def wait(self):
+        if self.rate <= 0:
+            return
+        self._refill()
+        while self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+            self._refill()
+
+    def charge(self, size: int):
+        if self.rate <= 0:
+            return
+        self._refill()
+        self._tokens -= size
+
+
+class FairSemaphore:
+    """
+    按所有者轮转的信号量: 释放的名额依次交给下一个有人在等的所有者,
+    页数多的本子不会因为排队早就占满全部连接
+    """
+
+    def __init__(self, value: int):
+        self._value = value
+        # 所有者 -> 等待中的 future, 所有者的顺序即轮转顺序
+        self._waiters: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+
+    def _wake_next(self):
+        while self._value > 0 and self._waiters:
+            owner, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            # 轮到过的所有者排到队尾
+            del self._waiters[owner]
+            if waiters:
+                self._waiters[owner] = waiters
+            if not future.done():
+                future.set_result(None)
+                self._value -= 1
+
+    async def acquire(self, owner: Hashable):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分到名额但被取消, 名额还回去
+                self.release()
+            else:
+                waiters = self._waiters.get(owner)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._waiters[owner]
+            raise
+
+    def release(self):
+        self._value += 1
+        self._wake_next()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+
+class DownloadScheduler:
+    """
+    所有下载共享的调度器: 全局连接数上限, 令牌桶带宽上限, 多个本子之间按页轮转
+    调度的单位是一次请求, 具体怎么请求由调用方的 fetch 决定
+    """
+
+    def __init__(self, connections: int = DOWNLOAD_CONNECTIONS, bandwidth: int = DOWNLOAD_BANDWIDTH,
+                 burst: int = DOWNLOAD_BURST):
+        self.connections = connections
+        self._slots = FairSemaphore(connections)
+        self._bucket = TokenBucket(bandwidth, burst)
+        self.active = 0
+        self.requests = 0
+        self.bytes = 0
+
+    @asynccontextmanager
+    async def slot(self, owner: Hashable):
+        await self._bucket.wait()
+        await self._slots.acquire(owner)
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._slots.release()
+
+    async def fetch(self, owner: Hashable, fetch: Callable[[T], Awaitable[R]], item: T,
+                    size: Callable[[R], int] = len) -> R:
+        async with self.slot(owner):
+            result = await fetch(item)
+        self.requests += 1
+        self.bytes += size(result)
+        self._bucket.charge(size(result))
+        return result
+
+    async def fetch_all(self, owner: Hashable, fetch: Callable[[T], Awaitable[R]], items: Iterable[T],
+                        size: Callable[[R], int] = len) -> AsyncIterator[tuple[T, R]]:
+        """
+        按完成顺序产出 (item, result); 每个所有者最多排 connections 个请求, 多了也拿不到连接
+        任意一个请求失败时取消其余请求并抛出异常
+        """
+        pending = iter(items)
+        results: asyncio.Queue = asyncio.Queue()
+
+        async def worker():
+            try:
+                for item in pending:
+                    await results.put((item, await self.fetch(owner, fetch, item, size), None))
+            except Exception as e:
+                await results.put((None, None, e))
+            finally:
+                await results.put(None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.connections)]
+        try:
+            running = len(workers)
+            while running:
+                entry = await results.get()
+                if entry is None:
+                    running -= 1
+                    continue
+                item, result, error = entry
+                if error is not None:
+                    raise error
+                yield item, result
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'connections': self.connections,
+            'active': self.active,
+            'waiting': self._slots.waiting,
+            'requests': self.requests,
+            'bytes': self.bytes
+        }
+
+
+download_scheduler = DownloadScheduler()
@@ -1,16 +1,20 @@
 import asyncio
-from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import HTMLResponse
 from fastapi import status
 import document_sql
 import hitomiv2
 import log_comic
+import thumbnail
 from pathlib import Path
-from shared import Authoricator, get_db, task_status, TaskStatus
+from shared import Authoricator, get_async_db, remove_task_status, update_task_status
+from site_utils import save_downloaded_offsets
+from static_assets import static_assets
 import document_db
+from download_queue import DownloadQueue, JobAbort, job_key
 import shutil
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Sequence
 
 
 class AddComicRequest(BaseModel):
@@ -46,7 +50,8 @@ async def refresh_hitomi_loop():
             break
 
 
-async def implement_document(comic: hitomiv2.Comic, tags: list[document_sql.Tag]):
+async def implement_document(comic: hitomiv2.Comic, tag_ids: Sequence[int], status_key: str):
+    """下载并录入一本, 失败时抛出异常由下载队列决定是否重试"""
     comic_authors_raw = comic.artists
     comic_authors_list = []
     if not comic_authors_raw:
@@ -55,79 +60,69 @@ async def implement_document(comic: hitomiv2.Comic, tags: list[document_sql.Tag]
         for author in comic_authors_raw:
             comic_authors_list.append(author.artist)
     raw_comic_path = log_comic.RAW_PATH / Path(f'{comic.id}.zip')
+    update_task_status(status_key, percent=0)
 
-    if raw_comic_path.exists():
-        task_status[comic.title] = TaskStatus(percent=0, message='预下载文件已存在, 请求人工接管')
-        return
-    task_status[comic.title] = TaskStatus(percent=0)
-    total_files_num = len(comic.files)
-    done_nums = 0
+    async def progress(done: int, total: int):
+        update_task_status(status_key, percent=round(done / total * 100, ndigits=2) if total else 100)
 
-    # noinspection PyUnusedLocal
-    async def phase_callback(url: str):
-        nonlocal done_nums
-        done_nums += 1
-        task_status[comic.title].percent = round(done_nums / total_files_num * 100, ndigits=2)
-
-    try:
-        with open(raw_comic_path, 'wb') as cf:
-            dl_result = await hitomiv2.download_comic(comic, cf, max_threads=5, phase_callback=phase_callback)
-    except Exception as dl_e:
-        dl_result = dl_e
-    if dl_result is False:
-        task_status[comic.title].message = '下载失败'
-        raw_comic_path.unlink(missing_ok=True)
-    elif isinstance(dl_result, str):
-        task_status[comic.title].message = f'下载失败, 异常: {dl_result}'
-        raw_comic_path.unlink(missing_ok=True)
-
-    comic_hash = await log_comic.get_file_hash(raw_comic_path)
+    # 上次运行留下的文件: 完整就直接录入, 否则校验已写入的页并只下载缺少的页
+    comic_hash, local_headers = await log_comic.download_raw_comic(comic, raw_comic_path, progress)
     hash_name = f'{comic_hash}.zip'
     final_path = log_comic.archived_document_path / Path(hash_name)
     if final_path.exists():
-        task_status[comic.title] = TaskStatus(percent=0, message='最终文件已存在, 请求人工接管')
-        return
-    with document_db.DocumentDB() as db:
-        comic_id = db.add_document(comic.title, final_path, authors=comic_authors_list, check_file=False)
-        if not comic_id or comic_id < 0:
-            task_status[comic.title] = TaskStatus(percent=0, message=f'无法添加本子: {comic_id}')
-            raw_comic_path.unlink()
-            return
-        for tag in tags:
-            db.link_document_tag(comic_id, tag)
-        link_result = db.link_document_source(comic_id, 1, str(comic.id))
-        if not link_result:
-            task_status[comic.title] = TaskStatus(percent=0, message='hitomi链接失败, 请求人工接管')
-            return
-    shutil.move(raw_comic_path, final_path)
+        raise JobAbort('最终文件已存在, 请求人工接管')
+    # 文档, 作者, 标签与来源一次写入
+    new_document = document_db.NewDocument(comic.title, final_path, authors=comic_authors_list, tags=tag_ids,
+                                           sources=[(1, str(comic.id))])
+    comic_id = (await document_db.get_writer().run(document_db.DocumentDB.add_documents, [new_document],
+                                                   check_file=False))[0]
+    if comic_id is None:
+        raise JobAbort('文件或hitomi来源已在库中, 请求人工接管')
+    # 跨文件系统时 move 是整本复制, 与写偏移一起放到线程里
+    await asyncio.to_thread(shutil.move, raw_comic_path, final_path)
+    await asyncio.to_thread(save_downloaded_offsets, final_path, local_headers)
+    try:
+        await thumbnail.generate_thumbnails(comic_id, final_path)
+    except Exception as th_e:
+        print(f'缩略图生成失败, 将在首次访问时重试: {th_e}')
+
+
+async def run_download_job(job: document_sql.DownloadJob):
+    comic = await hitomi.get_comic(job.source_document_id)
+    tag_ids = [int(tag_id) for tag_id in job.tag_ids.split(',') if tag_id]
+    await implement_document(comic, tag_ids, job_key(job))
+
+
+# 下载任务的调度器由 app 的 lifespan 启动
+download_queue = DownloadQueue(run_download_job)
 
 
 # noinspection PyUnusedLocal
 @router.get('/add',
             response_class=HTMLResponse,
             dependencies=[Depends(Authoricator())])
-async def add_comic(source_id: int, source_document_id: str):
-    return FileResponse('templates/add_comic.html')
+async def add_comic(request: Request, source_id: int, source_document_id: str):
+    return static_assets.template_response(request, 'add_comic.html')
 
 
 @router.post('/add', dependencies=[Depends(Authoricator())])
 async def add_comic_post(request: AddComicRequest,
-                         bg_tasks: BackgroundTasks,
-                         db: document_db.DocumentDB = Depends(get_db)) -> AddComicResponse:
+                         db: document_db.AsyncDocumentDB = Depends(get_async_db)) -> AddComicResponse:
     if request.source_id != 1:
         raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED)
     try:
         hitomi_result = await hitomi.get_comic(request.source_document_id)
     except Exception as e:
         return AddComicResponse(success=False, message=str(e))
-    db_result = db.search_by_source(source_document_id=request.source_document_id)
+    db_result = await db.search_by_source(source_document_id=request.source_document_id)
     if db_result:
-        task_status.pop(hitomi_result.title, None)
+        remove_task_status(request.source_document_id)
         return AddComicResponse(success=True, redirect_url=f'/show_document/{db_result.document_id}')
     raw_document_tags = log_comic.extract_generic_tags(hitomi_result)
     document_tags = []
+    resolved = await db.run(log_comic.resolve_generic_tags, raw_document_tags)
     for tag in raw_document_tags:
-        db_result = tag.query_db(db)
+        db_result = resolved.get(tag)
         if db_result:
             document_tags.append(db_result)
             continue
@@ -142,11 +137,15 @@ async def add_comic_post(request: AddComicRequest,
             return AddComicResponse(success=False, message=f'tag {tag.hitomi_name} name not found')
         tag.name = tag_info_by_req[1]
         try:
-            db_result = tag.add_db(db)
+            db_result = await db.write(tag.add_db)
         except Exception as e:
             return AddComicResponse(success=False, message=f'tag {tag.hitomi_name} db add failed: {str(e)}')
+        if db_result is None:
+            return AddComicResponse(success=False, message=f'tag {tag.hitomi_name} db add failed')
         document_tags.append(db_result)
-    bg_tasks.add_task(implement_document, hitomi_result, document_tags)
+    # 同一本已在队列中时不会重复下载
+    await download_queue.enqueue(request.source_id, request.source_document_id, hitomi_result.title,
+                                 [tag.tag_id for tag in document_tags])
     return AddComicResponse(success=True, redirect_url='/show_status')
 
 
@@ -159,10 +158,10 @@ class MissingTag(BaseModel):
             dependencies=[Depends(Authoricator())])
 async def get_missing_tags(source_id: int,
                            source_document_id: str,
-                           db: document_db.DocumentDB = Depends(get_db)) -> list[MissingTag]:
+                           db: document_db.AsyncDocumentDB = Depends(get_async_db)) -> list[MissingTag]:
     if source_id != 1:
         raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED)
-    db_result = db.search_by_source(source_document_id=source_document_id)
+    db_result = await db.search_by_source(source_document_id=source_document_id)
     if db_result:
         return []
     try:
@@ -171,9 +170,10 @@ async def get_missing_tags(source_id: int,
         raise HTTPException(status_code=404, detail=str(e))
 
     plain_tags = log_comic.extract_generic_tags(hitomi_result)
+    resolved = await db.run(log_comic.resolve_generic_tags, plain_tags)
     tags: list[MissingTag] = []
     for tag in plain_tags:
-        if tag.query_db(db):
+        if tag in resolved:
             continue
         tags.append(MissingTag(name=tag.hitomi_name, group_id=tag.group_id))
     return tags
@@ -0,0 +1,119 @@
+"""
+从清单批量导入文档: python import_library.py <manifest.jsonl> [--batch N] [--no-check]
+清单每行一个 JSON 对象:
+    {"title": "...", "file": "archived_documents/<md5>.zip", "authors": ["..."], "tags": ["标签名"],
+     "series": null, "volume": null, "source_id": 1, "source_document_id": "123"}
+每批文档在一个事务里写入, 文件或来源已在库中的文档跳过; 不合格的行报告后跳过, 不影响其余行
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+from tqdm import tqdm
+import document_db
+
+IMPORT_BATCH_SIZE = 500
+
+
+def read_manifest(manifest_path: Path) -> Iterator[tuple[int, dict]]:
+    """产出 (行号, 条目)"""
+    with open(manifest_path, encoding='utf-8') as mf:
+        for line_no, line in enumerate(mf, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except json.JSONDecodeError as e:
+                tqdm.write(f'第{line_no}行解析失败, 跳过: {e}')
+
+
+def validate_entry(entry: dict, check_file: bool) -> Optional[str]:
+    """按 add_documents 的要求检查一行, 不合格时返回原因; 整批在一个事务里, 一行抛异常会连累整批"""
+    if not isinstance(entry, dict):
+        return '不是 JSON 对象'
+    if not entry.get('title'):
+        return '缺少 title'
+    if not entry.get('file'):
+        return '缺少 file'
+    if check_file and not os.path.exists(entry['file']):
+        return f'{entry["file"]} 未找到'
+    for key in ('authors', 'tags'):
+        value = entry.get(key)
+        if value is not None and not (isinstance(value, list) and all(isinstance(name, str) for name in value)):
+            return f'{key} 必须为字符串列表'
+    if entry.get('series') and not entry.get('volume'):
+        return '有系列但没有卷号'
+    if entry.get('volume') and not str(entry['volume']).isdigit():
+        return '卷号必须为数字'
+    if entry.get('source_document_id') is not None and not str(entry.get('source_id', 1)).isdigit():
+        return 'source_id 必须为数字'
+    return None
+
+
+def to_new_document(entry: dict, tag_ids: dict[str, int]) -> document_db.NewDocument:
+    sources = []
+    if entry.get('source_document_id') is not None:
+        sources.append((int(entry.get('source_id', 1)), str(entry['source_document_id'])))
+    return document_db.NewDocument(
+        title=entry['title'],
+        filepath=entry['file'],
+        authors=tuple(entry.get('authors') or ('佚名',)),
+        tags=[tag_ids[name] for name in entry.get('tags') or () if name in tag_ids],
+        sources=sources,
+        series=entry.get('series'),
+        volume=entry.get('volume'))
+
+
+def import_batch(db: document_db.DocumentDB, lines: list[tuple[int, dict]], check_file: bool) -> tuple[int, int, int]:
+    """写入一批, 返回 (新增数, 跳过数, 不合格数)"""
+    entries = []
+    for line_no, entry in lines:
+        error = validate_entry(entry, check_file)
+        if error is None:
+            entries.append(entry)
+        else:
+            tqdm.write(f'第{line_no}行不合格, 跳过: {error}')
+    invalid = len(lines) - len(entries)
+    if not entries:
+        return 0, 0, invalid
+    tag_names = {name for entry in entries for name in entry.get('tags') or ()}
+    tag_ids = db.get_tag_ids_by_names(tag_names)
+    for name in sorted(tag_names - tag_ids.keys()):
+        tqdm.write(f'标签 {name} 不在库中, 已忽略')
+    results = db.add_documents([to_new_document(entry, tag_ids) for entry in entries], check_file=check_file)
+    added = sum(doc_id is not None for doc_id in results)
+    return added, len(results) - added, invalid
+
+
+def import_manifest(manifest_path: Path, batch_size: int = IMPORT_BATCH_SIZE, check_file: bool = True):
+    added = skipped = invalid = 0
+    start = time.perf_counter()
+    batch: list[tuple[int, dict]] = []
+    with document_db.DocumentDB() as db, tqdm(unit='doc') as progress:
+        for line in read_manifest(manifest_path):
+            batch.append(line)
+            if len(batch) >= batch_size:
+                batch_added, batch_skipped, batch_invalid = import_batch(db, batch, check_file)
+                added, skipped, invalid = added + batch_added, skipped + batch_skipped, invalid + batch_invalid
+                progress.update(len(batch))
+                batch = []
+        if batch:
+            batch_added, batch_skipped, batch_invalid = import_batch(db, batch, check_file)
+            added, skipped, invalid = added + batch_added, skipped + batch_skipped, invalid + batch_invalid
+            progress.update(len(batch))
+    elapsed = time.perf_counter() - start
+    print(f'新增 {added}, 跳过 {skipped}, 不合格 {invalid}, 用时 {elapsed:.2f}s, '
+          f'{(added + skipped + invalid) / max(elapsed, 1e-9):.1f} 文档/秒')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python import_library.py <manifest.jsonl> [--batch N] [--no-check]')
+        sys.exit(1)
+    batch_arg = IMPORT_BATCH_SIZE
+    if '--batch' in sys.argv:
+        batch_arg = int(sys.argv[sys.argv.index('--batch') + 1])
+    import_manifest(Path(sys.argv[1]), batch_size=batch_arg, check_file='--no-check' not in sys.argv)
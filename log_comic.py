@@ -1,15 +1,22 @@
 import asyncio
+import copy
+import io
+import json
 import os.path
 import re
 import shutil
 import sys
+import time
+import zipfile
 from pathlib import Path
-from typing import Optional, Self
+from typing import Awaitable, Callable, Iterable, Optional, Self
 import aioconsole
 import document_db
 import document_sql
+from download_scheduler import download_scheduler
 from hitomiv2 import Hitomi, Tag, Parody, Character, Comic, download_comic
-from site_utils import archived_document_path, get_file_hash
+from site_utils import (archived_document_path, get_file_hash, HashingWriter, save_downloaded_offsets,
+                        checkpoint_record, get_checkpoint_path, is_complete_archive, recover_partial_download)
 
 RAW_PATH = Path('raw_document')
 if not RAW_PATH.exists():
@@ -46,7 +53,9 @@ class GenericTag:
         raise TypeError(f'tag must be Tag or Parody or Character')
 
     def query_db(self, db: document_db.DocumentDB) -> Optional[document_sql.Tag]:
-        tag_info = db.get_tag_by_hitomi(self.hitomi_name)
+        return self.apply_db_tag(db.get_tag_by_hitomi(self.hitomi_name))
+
+    def apply_db_tag(self, tag_info: Optional[document_sql.Tag]) -> Optional[document_sql.Tag]:
         if tag_info is None:
             return None
         self.name = tag_info.name
@@ -87,6 +96,13 @@ class GenericTag:
         return self.hitomi_name == other.hitomi_name
 
 
+def resolve_generic_tags(db: document_db.DocumentDB, tags: Iterable[GenericTag]) -> dict[GenericTag, document_sql.Tag]:
+    """一次解析一组标签, 返回已入库的 GenericTag -> Tag, 不在结果里的即为缺失的标签"""
+    tags = list(tags)
+    db_tags = db.resolve_hitomi_tags(tag.hitomi_name for tag in tags)
+    return {tag: tag.apply_db_tag(db_tags[tag.hitomi_name]) for tag in tags if tag.hitomi_name in db_tags}
+
+
 def extract_generic_tags(comic: Comic) -> set[GenericTag]:
     result = set()
     for parody in comic.parodys:
@@ -116,8 +132,9 @@ async def implement_tags(comic: Comic, db: document_db.DocumentDB) -> list[docum
     for tag_group in db.get_tag_groups():
         print(f'{tag_group.tag_group_id}:{tag_group.group_name}')
     comic_tags: list[document_sql.Tag] = []
+    resolved = resolve_generic_tags(db, raw_comic_tags)
     for tag in raw_comic_tags:
-        db_result = tag.query_db(db)
+        db_result = resolved.get(tag)
         if db_result:
             comic_tags.append(db_result)
             continue
@@ -125,10 +142,99 @@ async def implement_tags(comic: Comic, db: document_db.DocumentDB) -> list[docum
         if tag.group_id is None:
             tag.group_id = await robust_input('输入tag组: ', 1)
         tag.name = await robust_input('输入tag名: ', 0)
-        comic_tags.append(tag.add_db(db))
+        comic_tags.append(await document_db.get_writer().run(tag.add_db))
     return comic_tags
 
 
+def page_entry_names(pages: list) -> list[str]:
+    """
+    每页在归档中的条目名: 按在图库中的位置编号, 只保留原文件的扩展名
+    阅读器按文件名自然排序出页, 页序只能由位置决定, 不能取决于上传者起的文件名; 页面按下载完成的先后写入也不影响
+    """
+    return [f'{index:04}{Path(page.name).suffix}' for index, page in enumerate(pages)]
+
+
+async def fetch_page(comic: Comic, page) -> bytes:
+    """
+    单独下载一页的图片内容
+    hitomiv2 只提供整本写成 zip 的 download_comic (地址与请求头都在其内部生成),
+    所以用只含这一页的 comic 副本下载到内存, 再取出唯一一个条目的内容
+    副本与内存 zip 本身每页约 100µs; download_comic 每次调用内部的准备工作 (如新建客户端与 TLS 上下文)
+    则变为每页一次, 以每次新建客户端模拟时吞吐从整本下载的约 220 页/s 降到约 20 页/s
+    """
+    single_page = copy.copy(comic)
+    single_page.files = [page]
+    buffer = io.BytesIO()
+    dl_result = await download_comic(single_page, buffer, max_threads=1)
+    if dl_result is False or isinstance(dl_result, str):
+        raise RuntimeError(f'{page.name} 下载失败' if dl_result is False else f'{page.name} 下载失败, 异常: {dl_result}')
+    with zipfile.ZipFile(buffer) as zip_ref:
+        infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+        if len(infos) != 1:
+            raise RuntimeError(f'{page.name} 下载结果应只有一个条目, 实际 {len(infos)} 个')
+        return zip_ref.read(infos[0])
+
+
+async def download_raw_comic(comic: Comic, raw_comic_path: Path,
+                             progress: Optional[Callable[[int, int], Awaitable[None]]] = None
+                             ) -> tuple[str, dict[int, int]]:
+    """
+    下载到 raw_comic_path, 返回 (MD5, 本地文件头位置); 已完整的文件直接沿用
+    每写完一页在检查点里记一行, 中断后再次调用时校验已写入的页, 只下载缺少的页
+    失败时保留文件与检查点, 留给下一次续传
+    """
+    total = len(comic.files)
+    if raw_comic_path.exists() and await asyncio.to_thread(is_complete_archive, raw_comic_path, total):
+        get_checkpoint_path(raw_comic_path).unlink(missing_ok=True)
+        return await get_file_hash(raw_comic_path), {}
+    entry_names = page_entry_names(comic.files)
+    partial = await asyncio.to_thread(recover_partial_download, raw_comic_path, set(entry_names))
+    if partial.pages:
+        print(f'{raw_comic_path} 已有 {len(partial.pages)}/{total} 页通过校验, 续传其余页')
+    missing = [(name, page) for name, page in zip(entry_names, comic.files) if name not in partial.pages]
+    done = total - len(missing)
+    if progress is not None:
+        await progress(done, total)
+    with open(raw_comic_path, 'r+b' if raw_comic_path.exists() else 'wb') as cf, \
+            open(get_checkpoint_path(raw_comic_path), 'w', encoding='utf-8') as checkpoint:
+        # 丢掉最后一个通过校验的条目之后的内容, 检查点也只留下对应的记录
+        cf.seek(partial.end_offset)
+        cf.truncate()
+        for record in partial.records:
+            checkpoint.write(json.dumps(record, ensure_ascii=False) + '\n')
+        checkpoint.flush()
+        # 边下载边算哈希并记录条目位置, 下载完成后不再重读整个文件
+        writer = HashingWriter.resume(cf, partial)
+        with zipfile.ZipFile(writer, 'w') as zip_ref:
+            # 已有的条目放回 filelist, 关闭时一并写进中央目录
+            for info in partial.pages.values():
+                zip_ref.filelist.append(info)
+                zip_ref.NameToInfo[info.filename] = info
+
+            def write_page(name: str, data: bytes):
+                # 图片本身已是压缩格式, 原样存储, 不再压缩一遍
+                entry = zipfile.ZipInfo(name, time.localtime()[:6])
+                entry.compress_type = zipfile.ZIP_STORED
+                entry.external_attr = 0o600 << 16
+                zip_ref.writestr(entry, data)
+                # 条目落盘之后才记检查点, 检查点里的页一定在文件里
+                writer.flush()
+                checkpoint.write(json.dumps(checkpoint_record(name, entry, writer.tell()),
+                                            ensure_ascii=False) + '\n')
+                checkpoint.flush()
+
+            # 逐页经过共享调度器: 所有本子合计的连接数与带宽有上限, 本子之间按页轮转
+            # 写盘与哈希放到线程里, 不阻塞其他本子的下载; 同一本的页依次写入, 不会并发访问 zip_ref
+            async for (name, _), data in download_scheduler.fetch_all(
+                    comic.id, lambda item: fetch_page(comic, item[1]), missing):
+                await asyncio.to_thread(write_page, name, data)
+                done += 1
+                if progress is not None:
+                    await progress(done, total)
+    get_checkpoint_path(raw_comic_path).unlink(missing_ok=True)
+    return writer.hexdigest(), writer.local_headers
+
+
 async def log_comic(hitomi: Hitomi, db: document_db.DocumentDB, hitomi_id: int):
     if db.search_by_source(str(hitomi_id)):
         print('已存在')
@@ -150,42 +256,30 @@ async def log_comic(hitomi: Hitomi, db: document_db.DocumentDB, hitomi_id: int):
     print('信息录入完成，开始获取源文件')
 
     raw_comic_path = RAW_PATH / Path(f'{hitomi_id}.zip')
-    dl_result = True
-    if raw_comic_path.exists():
-        print('检测到源文件已存在，跳过下载')
-    else:
-        with open(raw_comic_path, 'wb') as cf:
-            dl_result = await download_comic(comic, cf, max_threads=5)
-
-    if not dl_result:
-        print('下载失败')
+    try:
+        # 源文件已存在时校验已下载的页, 只补下缺少的
+        comic_hash, local_headers = await download_raw_comic(comic, raw_comic_path)
+    except Exception as e:
+        print(f'下载失败, 再次录入时续传: {e}')
         return
 
-    comic_hash = await get_file_hash(raw_comic_path)
     hash_name = f'{comic_hash}.zip'
     final_path = archived_document_path / Path(hash_name)
     if final_path.exists():
         raise FileExistsError(f'文件 {final_path} 已存在')
 
-    comic_id = db.add_document(comic.title, final_path, authors=comic_authors_list, check_file=False)
-    if not comic_id or comic_id < 0:
-        print(f'无法添加本子: {comic_id}')
-        raw_comic_path.unlink()
-        return
-    print('开始链接tags')
-    for tag in comic_tags:
-        link_result = db.link_document_tag(comic_id, tag)
-        if not link_result:
-            print(f'tag {tag}链接失败，错误id: {link_result}')
-    print('开始链接源')
-    link_result = db.link_document_source(comic_id, 1, str(hitomi_id))
-    if link_result:
-        print(f'成功将本子与源ID{hitomi_id}链接')
-    else:
-        print('链接失败')
+    print('写入数据库 (文档, 作者, tags, 源)')
+    new_document = document_db.NewDocument(comic.title, final_path, authors=comic_authors_list, tags=comic_tags,
+                                           sources=[(1, str(hitomi_id))])
+    comic_id = (await document_db.get_writer().run(document_db.DocumentDB.add_documents, [new_document],
+                                                   check_file=False))[0]
+    if comic_id is None:
+        print('文件或源ID已在库中, 跳过')
         return
+    print(f'成功录入本子{comic_id}并与源ID{hitomi_id}链接')
     print('录入完成，移入完成文件夹')
     shutil.move(raw_comic_path, final_path)
+    save_downloaded_offsets(final_path, local_headers)
 
 
 async def init_hitomi(hitomi: Hitomi):
@@ -204,6 +298,9 @@ if __name__ == '__main__':
     if raw_file_list:
         print('检测到有未完成录入，加入任务列表')
         for raw_file in raw_file_list:
+            # 检查点与归档同名, 只按归档排队
+            if not raw_file.endswith('.zip'):
+                continue
             hitomi_id_g = raw_file.split('.')[0]
             task_list.append(hitomi_id_g)
     if len(task_list) > 0:
@@ -228,4 +325,5 @@ if __name__ == '__main__':
             hitomi_id_g = extract_result
         with document_db.DocumentDB() as db_g:
             asyncio.run(log_comic(hitomi_instance, db_g, hitomi_id_g))
+    document_db.shutdown_writers()
     print('录入完成')
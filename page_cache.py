@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+from site_utils import ArchiveIndex, read_zip_entry
+
+# 页面缓存的内存预算 (字节)
+PAGE_CACHE_BYTES = int(os.environ.get('PAGE_CACHE_BYTES', 256 * 1024 * 1024))
+# 检测到顺序阅读时向后预读的页数
+READ_AHEAD_PAGES = int(os.environ.get('READ_AHEAD_PAGES', 4))
+READ_AHEAD_WORKERS = int(os.environ.get('READ_AHEAD_WORKERS', 2))
+# 记录最近访问位置的文档数量上限, 用于判断是否顺序阅读
+MAX_TRACKED_READERS = 256
+
+PageKey = tuple[Path, tuple[int, int], str]
+
+
+class PageCache:
+    """
+    按字节计量的页面 LRU 缓存, 带顺序阅读检测
+    请求第 n 页且看起来在顺序翻页时, 后台把 n+1..n+k 页读进缓存
+    """
+
+    def __init__(self, max_bytes: int = PAGE_CACHE_BYTES,
+                 read_ahead: int = READ_AHEAD_PAGES,
+                 workers: int = READ_AHEAD_WORKERS):
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+        # 单页超过预算的 1/8 就不缓存, 避免一张大图把缓存冲掉
+        self.max_page_bytes = max_bytes // 8
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pages: OrderedDict[PageKey, bytes] = OrderedDict()
+        self._inflight: set[PageKey] = set()
+        self._last_read: OrderedDict[Path, int] = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.evictions = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # 调用方需持有 self._lock
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='read_ahead')
+        return self._executor
+
+    def get(self, index: ArchiveIndex, name: str) -> Optional[bytes]:
+        key = (index.zip_path, index.stat_key, name)
+        with self._lock:
+            content = self._pages.get(key)
+            if content is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return content
+
+    def put(self, key: PageKey, content: bytes):
+        if len(content) > self.max_page_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.current_bytes -= len(old)
+            self._pages[key] = content
+            self.current_bytes += len(content)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+
+    def _prefetch(self, key: PageKey):
+        zip_path, _, name = key
+        try:
+            content = read_zip_entry(zip_path, name)
+            if content is not None:
+                self.put(key, content)
+        except Exception:
+            # 预读失败不影响正常请求, 真正读取时会再报错
+            pass
+        finally:
+            with self._lock:
+                self._inflight.discard(key)
+
+    def record_access(self, index: ArchiveIndex, page_no: int):
+        """记录一次页面访问, 判定为顺序阅读时安排预读"""
+        if self.read_ahead <= 0:
+            return
+        with self._lock:
+            last_page = self._last_read.pop(index.zip_path, None)
+            self._last_read[index.zip_path] = page_no
+            while len(self._last_read) > MAX_TRACKED_READERS:
+                self._last_read.popitem(last=False)
+            # 从头开始读, 或者在上次位置之后的预读窗口内, 都视为顺序阅读
+            sequential = page_no == 0 if last_page is None else 0 < page_no - last_page <= self.read_ahead
+            if not sequential:
+                return
+            self._schedule(index, page_no + 1, self.read_ahead)
+
+    def prefetch(self, index: ArchiveIndex, start: int, count: int):
+        """显式预读一段页面, 批量接口在发完一批后用它提前准备下一批"""
+        with self._lock:
+            self._schedule(index, start, count)
+
+    def _schedule(self, index: ArchiveIndex, start: int, count: int):
+        # 调用方需持有 self._lock
+        for name in index.names[start:start + count]:
+            key = (index.zip_path, index.stat_key, name)
+            if key in self._pages or key in self._inflight:
+                continue
+            info = index.infos[name]
+            if info.file_size > self.max_page_bytes:
+                continue
+            self._inflight.add(key)
+            self.prefetches += 1
+            self._get_executor().submit(self._prefetch, key)
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'prefetches': self.prefetches,
+                'evictions': self.evictions,
+                'pages': len(self._pages),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'read_ahead': self.read_ahead
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+page_cache = PageCache()
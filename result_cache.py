@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+# 查询结果缓存的内存预算 (字节)
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', 32 * 1024 * 1024))
+# 命令行等其他进程写库不会推进本进程的目录代数, 条目最多存活这么多秒
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 30))
+
+
+class ResultCache:
+    """
+    已序列化响应的 LRU 缓存, 每个条目记录生成时的目录代数
+    代数变化 (即本进程发生过写入) 或超过 TTL 的条目视为失效
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_BYTES, ttl: float = RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[int, float, bytes]] = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _discard(self, key: Hashable):
+        # 调用方需持有 self._lock
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= len(entry[2])
+
+    def get(self, key: Hashable, generation: int) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation or time.monotonic() - entry[1] > self.ttl:
+                self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: Hashable, generation: int, content: bytes):
+        """generation 应在查询开始前读取, 查询期间发生的写入会让这个条目直接作废"""
+        if len(content) > self.max_bytes // 8:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (generation, time.monotonic(), content)
+            self.current_bytes += len(content)
+            while self.current_bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+search_cache = ResultCache()
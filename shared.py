@@ -1,3 +1,5 @@
+import asyncio
+import threading
 import document_db
 import fastapi
 from pydantic import BaseModel
@@ -38,14 +40,94 @@ PAGE_COUNT = 10
 
 
 class TaskStatus(BaseModel):
+    title: str = ''
     percent: int | float = 0
     message: Optional[str] = None
 
 
-# 这里的 task_status 是全局共享的状态
+# 这里的 task_status 是全局共享的状态, 以来源 id 为键
+# 修改请通过 update_task_status / remove_task_status, 订阅者才能收到变更
 task_status: dict[str, TaskStatus] = {}
 
 
+class TaskSubscriber:
+    """一个 SSE 连接: 记录自上次发送以来变过的任务"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.dirty: set[str] = set()
+
+    def take(self) -> set[str]:
+        with task_updates.lock:
+            dirty, self.dirty = self.dirty, set()
+        self.changed.clear()
+        return dirty
+
+
+class TaskUpdates:
+    """task_status 的变更通知, 可以从任意线程调用 touch"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._subscribers: set[TaskSubscriber] = set()
+
+    def subscribe(self) -> TaskSubscriber:
+        subscriber = TaskSubscriber()
+        with self.lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: TaskSubscriber):
+        with self.lock:
+            self._subscribers.discard(subscriber)
+
+    def touch(self, key: str):
+        with self.lock:
+            subscribers = list(self._subscribers)
+            for subscriber in subscribers:
+                subscriber.dirty.add(key)
+        for subscriber in subscribers:
+            try:
+                if asyncio.get_running_loop() is subscriber.loop:
+                    subscriber.changed.set()
+                    continue
+            except RuntimeError:
+                pass
+            subscriber.loop.call_soon_threadsafe(subscriber.changed.set)
+
+
+task_updates = TaskUpdates()
+
+
+def update_task_status(key: str, **changes) -> TaskStatus:
+    status = task_status.setdefault(key, TaskStatus())
+    for name, value in changes.items():
+        setattr(status, name, value)
+    task_updates.touch(key)
+    return status
+
+
+def remove_task_status(key: str):
+    if task_status.pop(key, None) is not None:
+        task_updates.touch(key)
+
+
+def get_task_status_snapshot() -> dict[str, TaskStatus]:
+    """
+    task_status 的浅拷贝, 遍历请用它
+    remove_task_status 会在线程池里调用, 直接遍历 task_status 可能遇到 dictionary changed size during iteration;
+    list(dict.items()) 在持有 GIL 的一次调用里完成复制, 不会与其他线程的修改交错
+    """
+    return dict(list(task_status.items()))
+
+
 def get_db():
     with document_db.DocumentDB() as db:
         yield db
+
+
+async def get_async_db():
+    # 供 async def 端点使用, 数据库调用不会阻塞事件循环
+    async with document_db.AsyncDocumentDB() as db:
+        yield db
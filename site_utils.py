@@ -1,13 +1,28 @@
 import hashlib
+import json
 import os
-from typing import Optional
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Hashable, Iterator, NamedTuple, Optional, TypeVar
 import natsort
 import zipfile
 import io
 from pathlib import Path
 import aiofiles
+
+try:
+    import resource
+except ImportError:
+    # Windows 下没有 resource 模块, fd 预算退化为句柄数量上限
+    resource = None
+
 archived_document_path = Path('archived_documents')
 thumbnail_folder = Path('thumbnail')
+# 归档的偏移量索引单独存放, 不能放进 archived_documents, 否则会被当成游离文件清理掉
+archive_offsets_folder = Path('archive_index')
 
 if not os.path.exists(archived_document_path):
     os.makedirs(archived_document_path)
@@ -15,28 +30,351 @@ if not os.path.exists(archived_document_path):
 if not os.path.exists(thumbnail_folder):
     os.makedirs(thumbnail_folder)
 
+if not os.path.exists(archive_offsets_folder):
+    os.makedirs(archive_offsets_folder)
+
+# 同时保持打开的归档句柄上限
+MAX_OPEN_ARCHIVES = int(os.environ.get('MAX_OPEN_ARCHIVES', 64))
+# 归档句柄最多占用进程 fd 软上限的比例, 剩下的留给 socket 和数据库
+ARCHIVE_FD_RATIO = 0.25
+# 中央目录索引只占内存不占 fd, 可以比句柄多缓存一些
+MAX_CACHED_INDEXES = int(os.environ.get('MAX_CACHED_INDEXES', 1024))
+
+T = TypeVar('T')
+
+
+def get_archive_fd_budget() -> int:
+    if resource is None:
+        return MAX_OPEN_ARCHIVES
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return MAX_OPEN_ARCHIVES
+    return max(1, int(soft_limit * ARCHIVE_FD_RATIO))
+
+
+class _FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    按 key 合并并发的同类计算: 同一时刻只有一个调用方真正执行,
+    其余调用方阻塞等待并拿到同一个结果 (或同一个异常)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, _FlightCall] = {}
+
+    def do(self, key: Hashable, fn: Callable[..., T], *args, **kwargs) -> T:
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _FlightCall()
+                self._calls[key] = call
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+
+@contextmanager
+def atomic_write(target_path: Path, mode: str = 'wb', **open_kwargs) -> Iterator[IO]:
+    """先写同目录下的临时文件, 写完再原子改名, 读者要么看到旧文件要么看到完整的新文件"""
+    temp_path = target_path.with_name(f'.{target_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(temp_path, mode, **open_kwargs) as fo:
+            yield fo
+        os.replace(temp_path, target_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+class EntryOffset(NamedTuple):
+    """归档内单个条目的数据在文件中的位置"""
+    data_offset: int
+    length: int
+    file_size: int
+    compress_type: int
+    crc: int
+    encrypted: bool = False
+
+    @property
+    def is_stored(self) -> bool:
+        # 只有未压缩且未加密的条目可以直接按字节区间发送
+        return self.compress_type == zipfile.ZIP_STORED and not self.encrypted
+
+
+# 本地文件头: 签名, 版本, 标志, 压缩方式, 时间, 日期, CRC, 压缩大小, 原始大小, 文件名长度, 扩展字段长度
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def compute_entry_offsets(zip_path: Path, infos: dict[str, zipfile.ZipInfo]) -> dict[str, EntryOffset]:
+    """读取每个条目的本地文件头, 算出数据区起点. 本地头的扩展字段长度可能和中央目录不同, 必须实际读取"""
+    offsets: dict[str, EntryOffset] = {}
+    with open(zip_path, 'rb') as fp:
+        for name, info in infos.items():
+            fp.seek(info.header_offset)
+            header = fp.read(_LOCAL_HEADER.size)
+            if len(header) != _LOCAL_HEADER.size:
+                raise zipfile.BadZipFile(f'{name} 的本地文件头被截断')
+            fields = _LOCAL_HEADER.unpack(header)
+            if fields[0] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(f'{name} 的本地文件头签名错误')
+            name_len, extra_len = fields[9], fields[10]
+            offsets[name] = EntryOffset(data_offset=info.header_offset + _LOCAL_HEADER.size + name_len + extra_len,
+                                        length=info.compress_size,
+                                        file_size=info.file_size,
+                                        compress_type=info.compress_type,
+                                        crc=info.CRC,
+                                        encrypted=bool(info.flag_bits & 0x1))
+    return offsets
+
+
+def get_offsets_sidecar_path(zip_path: Path) -> Path:
+    return archive_offsets_folder / Path(f'{zip_path.name}.json')
+
+
+def load_entry_offsets(zip_path: Path, stat_key: tuple[int, int]) -> Optional[dict[str, EntryOffset]]:
+    sidecar_path = get_offsets_sidecar_path(zip_path)
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as fi:
+            sidecar = json.load(fi)
+    except (OSError, ValueError):
+        return None
+    if sidecar.get('size') != stat_key[1] or sidecar.get('mtime_ns') != stat_key[0]:
+        return None
+    return {name: EntryOffset(*entry) for name, entry in sidecar['entries'].items()}
+
+
+def save_entry_offsets(zip_path: Path, stat_key: tuple[int, int], offsets: dict[str, EntryOffset]):
+    sidecar_path = get_offsets_sidecar_path(zip_path)
+    sidecar = {
+        'mtime_ns': stat_key[0],
+        'size': stat_key[1],
+        'entries': {name: list(entry) for name, entry in offsets.items()}
+    }
+    with atomic_write(sidecar_path, 'w', encoding='utf-8') as fo:
+        json.dump(sidecar, fo, ensure_ascii=False)
+
+
+class ArchiveIndex:
+    """
+    单个归档的中央目录索引
+    names 为自然排序后的页面列表, infos 为 文件名->ZipInfo 映射,
+    offsets 为 文件名->数据区偏移, 优先从侧车文件读取, 没有就现算并落盘
+    """
+
+    def __init__(self, zip_path: Path, stat_key: tuple[int, int], zip_ref: zipfile.ZipFile):
+        self.zip_path = zip_path
+        self.stat_key = stat_key
+        self.infos: dict[str, zipfile.ZipInfo] = {info.filename: info
+                                                  for info in zip_ref.infolist() if not info.is_dir()}
+        self.names: list[str] = natsort.natsorted(self.infos)
+        offsets = load_entry_offsets(zip_path, stat_key)
+        if offsets is None or offsets.keys() != self.infos.keys():
+            offsets = compute_entry_offsets(zip_path, self.infos)
+            try:
+                save_entry_offsets(zip_path, stat_key, offsets)
+            except OSError:
+                # 侧车只是加速用的, 写不进去也不影响服务
+                pass
+        self.offsets: dict[str, EntryOffset] = offsets
+
+    def __len__(self):
+        return len(self.names)
+
+
+class _ArchiveHandle:
+    def __init__(self, zip_ref: zipfile.ZipFile, stat_key: tuple[int, int]):
+        self.zip_ref = zip_ref
+        self.stat_key = stat_key
+        # 正在使用该句柄的调用方数量, 被淘汰时要等它归零才能关闭
+        self.leases = 0
+        self.evicted = False
+
+
+def _stat_key(zip_path: Path) -> tuple[int, int]:
+    st = zip_path.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+class ArchivePool:
+    """
+    进程级的归档句柄池
+    打开的 ZipFile 按 LRU 淘汰, 上限取数量上限与 fd 预算中较小的一个;
+    中央目录索引单独缓存, 句柄被淘汰后索引仍可复用
+    """
+
+    def __init__(self, max_handles: int = MAX_OPEN_ARCHIVES, max_indexes: int = MAX_CACHED_INDEXES):
+        self.max_handles = max(1, min(max_handles, get_archive_fd_budget()))
+        self.max_indexes = max_indexes
+        self._lock = threading.Lock()
+        self._handles: OrderedDict[Path, _ArchiveHandle] = OrderedDict()
+        self._indexes: OrderedDict[Path, ArchiveIndex] = OrderedDict()
+        self._opening = SingleFlight()
+
+    def _evict_handles(self):
+        # 调用方需持有 self._lock
+        while len(self._handles) > self.max_handles:
+            _, handle = self._handles.popitem(last=False)
+            handle.evicted = True
+            if handle.leases == 0:
+                handle.zip_ref.close()
+
+    def _store_index(self, index: ArchiveIndex):
+        # 调用方需持有 self._lock
+        self._indexes[index.zip_path] = index
+        self._indexes.move_to_end(index.zip_path)
+        while len(self._indexes) > self.max_indexes:
+            self._indexes.popitem(last=False)
+
+    def _open_handle(self, zip_path: Path, stat_key: tuple[int, int]) -> _ArchiveHandle:
+        # 在锁外解析中央目录, 避免一个大归档拖住所有请求
+        zip_ref = zipfile.ZipFile(zip_path, 'r')
+        try:
+            new_index = ArchiveIndex(zip_path, stat_key, zip_ref)
+        except Exception:
+            zip_ref.close()
+            raise
+        new_handle = _ArchiveHandle(zip_ref, stat_key)
+        with self._lock:
+            handle = self._handles.pop(zip_path, None)
+            if handle is not None:
+                # 文件已被替换, 旧句柄作废
+                handle.evicted = True
+                if handle.leases == 0:
+                    handle.zip_ref.close()
+            self._handles[zip_path] = new_handle
+            self._store_index(new_index)
+            self._evict_handles()
+        return new_handle
+
+    def _acquire(self, zip_path: Path) -> _ArchiveHandle:
+        stat_key = _stat_key(zip_path)
+        while True:
+            with self._lock:
+                handle = self._handles.get(zip_path)
+                if handle is not None and handle.stat_key == stat_key:
+                    self._handles.move_to_end(zip_path)
+                    handle.leases += 1
+                    return handle
+            # 同一归档的并发打开合并成一次中央目录解析
+            handle = self._opening.do((zip_path, stat_key), self._open_handle, zip_path, stat_key)
+            with self._lock:
+                if not handle.evicted or handle.leases > 0:
+                    handle.leases += 1
+                    return handle
+            # 刚放进池就被挤出去并关闭了, 重新打开
+
+    def _release(self, handle: _ArchiveHandle):
+        with self._lock:
+            handle.leases -= 1
+            if handle.evicted and handle.leases == 0:
+                handle.zip_ref.close()
+
+    @contextmanager
+    def open(self, zip_path: Path) -> Iterator[zipfile.ZipFile]:
+        """借出一个共享的 ZipFile, 只能用于读取, 不要关闭它"""
+        handle = self._acquire(zip_path)
+        try:
+            yield handle.zip_ref
+        finally:
+            self._release(handle)
+
+    def get_index(self, zip_path: Path) -> ArchiveIndex:
+        stat_key = _stat_key(zip_path)
+        with self._lock:
+            index = self._indexes.get(zip_path)
+            if index is not None and index.stat_key == stat_key:
+                self._indexes.move_to_end(zip_path)
+                return index
+        # 打开句柄时会顺带建立索引
+        with self.open(zip_path):
+            pass
+        with self._lock:
+            return self._indexes[zip_path]
+
+    def invalidate(self, zip_path: Path):
+        with self._lock:
+            self._indexes.pop(zip_path, None)
+            handle = self._handles.pop(zip_path, None)
+            if handle is not None:
+                handle.evicted = True
+                if handle.leases == 0:
+                    handle.zip_ref.close()
+
+
+archive_pool = ArchivePool()
+
+
+def get_archive_index(zip_path: Path) -> Optional[ArchiveIndex]:
+    if not zip_path.exists():
+        return None
+    return archive_pool.get_index(zip_path)
+
 
 def get_zip_namelist(zip_path: Path) -> str | list[str]:
     if not zip_path.exists():
         return f"{os.listdir(archived_document_path)}"
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        return natsort.natsorted(zip_ref.namelist())
+    return archive_pool.get_index(zip_path).names
+
+
+# 同一页面的并发解码只做一次
+page_flight = SingleFlight()
+
+
+def _read_zip_entry(zip_path: Path, zip_info: zipfile.ZipInfo) -> bytes:
+    with archive_pool.open(zip_path) as zip_ref:
+        with zip_ref.open(zip_info) as img_file:
+            return img_file.read()
+
+
+def read_zip_entry(zip_path: Path, pic_name: str) -> Optional[bytes]:
+    index = get_archive_index(zip_path)
+    if index is None:
+        return None
+    zip_info = index.infos.get(pic_name)
+    if zip_info is None:
+        return None
+    return page_flight.do((zip_path, index.stat_key, pic_name), _read_zip_entry, zip_path, zip_info)
 
 
 def get_zip_image(zip_path: Path, pic_name: str) -> Optional[io.BytesIO]:
-    # 检查 zip 文件是否存在
-    if not zip_path.exists():
+    # 每个调用方拿到独立的 BytesIO, 底层字节可以共享
+    img_data = read_zip_entry(zip_path, pic_name)
+    if img_data is None:
         return None
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        # 检查图片文件是否存在
-        if pic_name not in zip_ref.namelist():
-            return None
-        # 读取图片文件内容并加载到内存
-        with zip_ref.open(pic_name) as img_file:
-            # 使用 BytesIO 将文件内容转为内存字节流
-            img_data = img_file.read()
-            img_bytes = io.BytesIO(img_data)
-            return img_bytes
+    return io.BytesIO(img_data)
+
+
+def iter_zip_entry(zip_path: Path, pic_name: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    按固定大小分块解压条目, 整个迭代期间持有句柄租约
+    消费方每取一块才会解压下一块, 单次请求的内存占用与页面大小无关
+    """
+    index = archive_pool.get_index(zip_path)
+    zip_info = index.infos[pic_name]
+    with archive_pool.open(zip_path) as zip_ref:
+        with zip_ref.open(zip_info) as entry_file:
+            while chunk := entry_file.read(chunk_size):
+                yield chunk
 
 
 async def get_file_hash(file_path: Path, chunk_size: int = 65536) -> str:
@@ -46,3 +384,207 @@ async def get_file_hash(file_path: Path, chunk_size: int = 65536) -> str:
         while chunk := await f.read(chunk_size):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
+
+
+class HashingWriter:
+    """
+    下载用的写入包装: 边写边算 MD5, 并记下流经的每个本地文件头的位置和长度
+    对外声明不可 seek, zipfile 会改用数据描述符顺序写入而不回头改写文件头,
+    因此写完时的增量哈希就是最终文件的哈希, 不必再把整个文件读一遍
+    """
+
+    def __init__(self, fo: IO[bytes]):
+        self._fo = fo
+        self._md5 = hashlib.md5()
+        self._position = 0
+        # 本地文件头偏移 -> 文件头总长度 (含文件名与扩展字段)
+        self.local_headers: dict[int, int] = {}
+
+    def write(self, data) -> int:
+        # zipfile 总是一次 write 写出完整的本地文件头; 数据里碰巧出现的签名不会与中央目录的偏移对上, 无害
+        if len(data) >= _LOCAL_HEADER.size and data[:4] == b'PK\x03\x04':
+            fields = _LOCAL_HEADER.unpack_from(data)
+            self.local_headers[self._position] = _LOCAL_HEADER.size + fields[9] + fields[10]
+        written = self._fo.write(data)
+        self._md5.update(data)
+        self._position += len(data)
+        return written
+
+    @classmethod
+    def resume(cls, fo: IO[bytes], partial: 'PartialDownload') -> 'HashingWriter':
+        """接着中断的下载写, fo 需已定位到 partial.end_offset"""
+        writer = cls(fo)
+        writer._md5 = partial.md5
+        writer._position = partial.end_offset
+        writer.local_headers = dict(partial.local_headers)
+        return writer
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        self._fo.flush()
+
+    @staticmethod
+    def seekable() -> bool:
+        return False
+
+    def seek(self, *args):
+        raise io.UnsupportedOperation('HashingWriter 只支持顺序写入')
+
+    @staticmethod
+    def writable() -> bool:
+        return True
+
+    def hexdigest(self) -> str:
+        return self._md5.hexdigest()
+
+
+def save_downloaded_offsets(zip_path: Path, local_headers: dict[int, int]):
+    """
+    用下载时记下的本地文件头为归档写好偏移量侧车, 首次访问不必再逐个读文件头
+    只读取文件尾部的中央目录; 没记下的条目退回 compute_entry_offsets
+    """
+    try:
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            infos = {info.filename: info for info in zip_ref.infolist() if not info.is_dir()}
+        offsets: dict[str, EntryOffset] = {}
+        for name, info in infos.items():
+            header_size = local_headers.get(info.header_offset)
+            if header_size is None:
+                continue
+            offsets[name] = EntryOffset(data_offset=info.header_offset + header_size,
+                                        length=info.compress_size,
+                                        file_size=info.file_size,
+                                        compress_type=info.compress_type,
+                                        crc=info.CRC,
+                                        encrypted=bool(info.flag_bits & 0x1))
+        if len(offsets) != len(infos):
+            offsets.update(compute_entry_offsets(zip_path, {name: info for name, info in infos.items()
+                                                            if name not in offsets}))
+        save_entry_offsets(zip_path, _stat_key(zip_path), offsets)
+    except (OSError, zipfile.BadZipFile):
+        # 侧车只是加速用的, 首次访问时会重新计算
+        pass
+
+
+def is_complete_archive(zip_path: Path, expected_entries: int) -> bool:
+    """中央目录可读, 条目数符合预期且全部通过 CRC 校验"""
+    try:
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+            return len(infos) == expected_entries and zip_ref.testzip() is None
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+def get_checkpoint_path(zip_path: Path) -> Path:
+    """下载中的归档旁边的检查点, 每写完一页追加一行 JSON"""
+    return zip_path.with_name(f'{zip_path.name}.pages')
+
+
+def checkpoint_record(page_key: str, info: zipfile.ZipInfo, end_offset: int) -> dict:
+    return {
+        'page': page_key,
+        'name': info.filename,
+        'date_time': list(info.date_time),
+        'compress_type': info.compress_type,
+        'external_attr': info.external_attr,
+        'flag_bits': info.flag_bits,
+        'header_offset': info.header_offset,
+        'crc': info.CRC,
+        'compress_size': info.compress_size,
+        'file_size': info.file_size,
+        'end_offset': end_offset
+    }
+
+
+def _checkpoint_info(record: dict) -> zipfile.ZipInfo:
+    # 续写时放回 ZipFile.filelist, 关闭时与新条目一起写进中央目录
+    info = zipfile.ZipInfo(record['name'], tuple(record['date_time']))
+    info.compress_type = record['compress_type']
+    info.external_attr = record['external_attr']
+    info.flag_bits = record['flag_bits']
+    info.header_offset = record['header_offset']
+    info.CRC = record['crc']
+    info.compress_size = record['compress_size']
+    info.file_size = record['file_size']
+    return info
+
+
+def _verify_entry(chunk: bytes, record: dict) -> Optional[int]:
+    """校验一个条目的本地文件头、文件名与 CRC, 通过时返回文件头长度"""
+    if len(chunk) < _LOCAL_HEADER.size:
+        return None
+    fields = _LOCAL_HEADER.unpack_from(chunk)
+    if fields[0] != b'PK\x03\x04':
+        return None
+    name_end = _LOCAL_HEADER.size + fields[9]
+    header_size = name_end + fields[10]
+    name = chunk[_LOCAL_HEADER.size:name_end].decode('utf-8' if fields[2] & 0x800 else 'cp437', errors='replace')
+    data = chunk[header_size:header_size + record['compress_size']]
+    if name != record['name'] or len(data) != record['compress_size']:
+        return None
+    if record['compress_type'] == zipfile.ZIP_STORED:
+        content = data
+    elif record['compress_type'] == zipfile.ZIP_DEFLATED:
+        try:
+            content = zlib.decompress(data, -15)
+        except zlib.error:
+            return None
+    else:
+        return None
+    if len(content) != record['file_size'] or zlib.crc32(content) != record['crc']:
+        return None
+    return header_size
+
+
+class PartialDownload(NamedTuple):
+    """中断的下载里通过校验的前缀"""
+    # 页面标识 -> 条目
+    pages: dict[str, zipfile.ZipInfo]
+    records: list[dict]
+    end_offset: int
+    md5: Any
+    local_headers: dict[int, int]
+
+
+def recover_partial_download(zip_path: Path, expected_pages: Optional[set[str]] = None) -> PartialDownload:
+    """
+    按检查点逐个校验已写入的条目: 位置首尾相接, 本地文件头与文件名一致, 解压后 CRC 正确
+    遇到第一个不合格的条目就停下, 其后的内容丢弃重下; 顺序读取的同时算好前缀的 MD5
+    给出 expected_pages 时, 不在其中的页 (例如源站改了页面列表) 也算不合格
+    """
+    records: list[dict] = []
+    try:
+        with open(get_checkpoint_path(zip_path), 'r', encoding='utf-8') as fi:
+            for line in fi:
+                # 最后一行可能没写完
+                if not line.endswith('\n'):
+                    break
+                records.append(json.loads(line))
+    except (OSError, ValueError):
+        pass
+    md5 = hashlib.md5()
+    valid: list[dict] = []
+    local_headers: dict[int, int] = {}
+    end_offset = 0
+    try:
+        with open(zip_path, 'rb') as fp:
+            for record in records:
+                if record['header_offset'] != end_offset:
+                    break
+                if expected_pages is not None and record['page'] not in expected_pages:
+                    break
+                chunk = fp.read(record['end_offset'] - end_offset)
+                header_size = _verify_entry(chunk, record)
+                if len(chunk) != record['end_offset'] - end_offset or header_size is None:
+                    break
+                md5.update(chunk)
+                local_headers[end_offset] = header_size
+                end_offset = record['end_offset']
+                valid.append(record)
+    except OSError:
+        pass
+    return PartialDownload(pages={record['page']: _checkpoint_info(record) for record in valid},
+                           records=valid, end_offset=end_offset, md5=md5, local_headers=local_headers)
@@ -134,9 +134,13 @@ function switchPage(event) {
 
 
 /**
- * @typedef {{target_tag: number, author_name: string, target_page: number}} SearchArgs
+ * @typedef {{target_tag: number, author_name: string, target_page: number, cursor: ?number, with_total: boolean}} SearchArgs
  */
 
+// 页码 -> 该页的游标 (上一页最后一个文档的 id), 有游标时后端走主键范围扫描
+let pageCursors = {};
+let knownTotalCount = null;
+
 /**
  *
  * @param {number} target_page
@@ -145,7 +149,17 @@ function switchPage(event) {
 
 function updateSearchArgs(target_page) {
     if (target_page === null)target_page = 1;
-    let searchArgs = {target_tag: 0, author_name: '', target_page: target_page};
+    let searchArgs = {target_tag: 0, author_name: '', target_page: target_page, cursor: null, with_total: true};
+    // 回到第一页视为新的查询, 之前记下的游标全部作废
+    if (target_page === 1) {
+        pageCursors = {};
+        knownTotalCount = null;
+    }
+    if (pageCursors[target_page] !== undefined) {
+        searchArgs.cursor = pageCursors[target_page];
+        // 同一查询的总数已经知道了, 不用再数一遍
+        searchArgs.with_total = knownTotalCount === null;
+    }
     const tag_name = document.getElementById('dropdown-input').value;
     const tag_select_list = document.getElementById('dropdown-list');
     let tag_id = 0;
@@ -213,7 +227,9 @@ function createDocument(document_info, tags_info, author_list) {
     document_item.className = 'list-item';
     let document_thumbnail = document.createElement('img');
     document_thumbnail.className = 'thumbnail';
-    document_thumbnail.src = '/document_content/' + document_info.document_id + '/-1';
+    // 缩略图按显示宽度乘以像素比请求, 与 exploror.css 中 .thumbnail 的宽度保持一致
+    document_thumbnail.src = '/document_content/' + document_info.document_id + '/-1?w=' +
+        Math.ceil(120 * (window.devicePixelRatio || 1));
     document_item.appendChild(document_thumbnail);
     let document_details = document.createElement('div');
     document_details.className = 'details'
@@ -269,11 +285,19 @@ function createDocument(document_info, tags_info, author_list) {
  */
 
 /**
- * @typedef {Object} SearchDocumentResponse
- * @property {number} total_count
- * @property {{[doc_id: number]: Array<string>}} document_authors
- * @property {{[doc_id: number]: DocumentInfo}} documents_info - 对应 dict[int, Document]
- * @property {{[doc_id: number]: Array<TagInfo>}} tags - 对应 dict[int, list[Tag]]，注意这里是数组
+ * /search_document_columns 的返回, 除三个字典外每个数组都与 document_ids 一一对应
+ * @typedef {Object} SearchDocumentColumns
+ * @property {?number} total_count - 请求 with_total 为 false 时为 null
+ * @property {?number} next_cursor - 下一页的游标, 没有下一页时为 null
+ * @property {Array<number>} document_ids - 已按显示顺序排好
+ * @property {Array<string>} titles
+ * @property {Array<?string>} series_names
+ * @property {Array<?number>} volume_numbers
+ * @property {Array<Array<number>>} author_ids
+ * @property {Array<Array<number>>} tag_ids
+ * @property {{[author_id: number]: string}} author_names - 本页出现过的作者
+ * @property {{[tag_id: number]: string}} tag_names - 本页出现过的标签
+ * @property {{[tag_id: number]: ?number}} tag_group_ids
  */
 
 /**
@@ -286,31 +310,35 @@ function requestDocuments(target_page) {
     console.log('查询参数: ' + search_args_json)
     $.ajax({
         type: 'POST',
-        url: '/search_document',
+        url: '/search_document_columns',
         data: search_args_json,
         contentType: 'application/json;charset=UTF-8',
         success: function (response) {
             console.log('search_document 成功返回');
             documentsContainer.innerHTML = '';
-            let document_count = response.total_count;
+            if (response.total_count !== null) knownTotalCount = response.total_count;
+            if (response.next_cursor !== null) pageCursors[search_args.target_page + 1] = response.next_cursor;
             const total_page_item = document.getElementById('total-page');
-            total_page_item.textContent = Math.ceil(document_count / 10).toString();
+            total_page_item.textContent = Math.ceil(knownTotalCount / 10).toString();
             console.log('开始构造文档列表')
-            let document_map = response.documents_info;
-            let tag_map = response.tags;
-            let author_map = response.document_authors;
-            // 2. 遍历文档字典
-            // 使用 Object.keys() 或 for...in 均可，这里推荐 Object.entries 以同时获取 ID 和 对象
-            Object.entries(document_map)
-                .sort((a, b) => parseInt(b[0]) - parseInt(a[0]))
-                .forEach(([key, doc_info]) => {
-                // 注意：Object 的键在 JS 运行时是字符串，如果需要数字类型可能需要 parseInt(key)
-                // 但作为索引访问对象属性时，字符串 key 是安全的
-                // 3. 通过 ID 在 tags 字典中查找对应的标签数组
-                // 添加 || [] 是防御性编程，防止某个文档没有对应的标签记录导致报错
-                let relevant_tags = tag_map[key] || [];
-                let relevent_authors = author_map[key] || [];
-                console.log('开始构造文档' + key)
+            /** @type {SearchDocumentColumns} */
+            let columns = response;
+            // 服务端已按显示顺序排好 (关键词检索为相关度顺序), 直接按下标遍历
+            columns.document_ids.forEach((document_id, index) => {
+                let doc_info = {
+                    document_id: document_id,
+                    title: columns.titles[index],
+                    series_name: columns.series_names[index],
+                    volume_number: columns.volume_numbers[index]
+                };
+                // 共享字典里按 id 取名字, JSON 对象的键是字符串, 用数字下标访问同样有效
+                let relevant_tags = columns.tag_ids[index].map(tag_id => ({
+                    tag_id: tag_id,
+                    name: columns.tag_names[tag_id],
+                    group_id: columns.tag_group_ids[tag_id]
+                }));
+                let relevent_authors = columns.author_ids[index].map(author_id => columns.author_names[author_id]);
+                console.log('开始构造文档' + document_id)
                 createDocument(doc_info, relevant_tags, relevent_authors);
             });
         }
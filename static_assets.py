@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import mimetypes
+import re
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+import fastapi
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+asset_folder = Path('src')
+template_folder = Path('templates')
+
+# 带指纹的资源内容永不改变, 浏览器缓存一年且不再校验; 需要登录才能访问, 不允许共享缓存保存
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# 页面和未带指纹的旧地址每次都要校验, 未变化时只回 304
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+# 小于这个大小的文件压缩收益抵不过头部开销
+MIN_COMPRESS_SIZE = 256
+FINGERPRINT_LENGTH = 12
+# 已经是压缩格式的文件不再压缩
+INCOMPRESSIBLE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.ico', '.zip', '.gz', '.br'}
+
+
+class StaticAsset(NamedTuple):
+    media_type: str
+    etag: str
+    # 内容编码 -> 字节, 'identity' 总是存在
+    variants: dict[str, bytes]
+
+
+def _build_asset(content: bytes, media_type: str, compressible: bool) -> StaticAsset:
+    digest = hashlib.sha256(content).hexdigest()
+    variants = {'identity': content}
+    if compressible and len(content) >= MIN_COMPRESS_SIZE:
+        # 启动时压一次, 用最高压缩级别; 压完反而更大的变体不保留
+        compressed = gzip.compress(content, compresslevel=9, mtime=0)
+        if len(compressed) < len(content):
+            variants['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(content, quality=11)
+            if len(compressed) < len(content):
+                variants['br'] = compressed
+    return StaticAsset(media_type, f'"{digest[:32]}"', variants)
+
+
+def _accepted_encodings(accept_encoding: str) -> set[str]:
+    encodings = set()
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        try:
+            # q=0 表示明确拒绝
+            if params.startswith('q=') and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def fingerprinted_name(filename: str, digest: str) -> str:
+    """exploror.js -> exploror.<hash>.js"""
+    path = Path(filename)
+    return f'{path.stem}.{digest[:FINGERPRINT_LENGTH]}{path.suffix}'
+
+
+class StaticAssets:
+    """
+    静态资源管线: 启动时为 src 下每个文件计算内容哈希, 以带指纹的文件名提供并声明 immutable,
+    同时预先生成 gzip/brotli 变体; 模板中的 /src/ 引用在载入时替换为带指纹的地址
+    文件改动需要重启进程才会生效
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assets: dict[str, StaticAsset] = {}
+        # 原文件名 -> 带指纹的文件名
+        self._fingerprints: dict[str, str] = {}
+        self._templates: dict[str, StaticAsset] = {}
+        self.loaded = False
+
+    def load(self):
+        assets: dict[str, StaticAsset] = {}
+        fingerprints: dict[str, str] = {}
+        for path in sorted(asset_folder.iterdir()):
+            if not path.is_file():
+                continue
+            content = path.read_bytes()
+            media_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+            asset = _build_asset(content, media_type, path.suffix.lower() not in INCOMPRESSIBLE_SUFFIXES)
+            fingerprint = fingerprinted_name(path.name, asset.etag.strip('"'))
+            assets[path.name] = asset
+            assets[fingerprint] = asset
+            fingerprints[path.name] = fingerprint
+        pattern = re.compile(r'/src/([\w.-]+)')
+
+        def substitute(match: re.Match) -> str:
+            name = match.group(1)
+            return f'/src/{fingerprints[name]}' if name in fingerprints else match.group(0)
+
+        templates: dict[str, StaticAsset] = {}
+        for path in sorted(template_folder.glob('*.html')):
+            html = pattern.sub(substitute, path.read_text(encoding='utf-8'))
+            templates[path.name] = _build_asset(html.encode('utf-8'), 'text/html; charset=utf-8', True)
+        with self._lock:
+            self._assets = assets
+            self._fingerprints = fingerprints
+            self._templates = templates
+            self.loaded = True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    @staticmethod
+    def _respond(request: fastapi.Request, asset: StaticAsset, cache_control: str) -> fastapi.Response:
+        accepted = _accepted_encodings(request.headers.get('accept-encoding', ''))
+        encoding = next((name for name in ('br', 'gzip') if name in accepted and name in asset.variants), 'identity')
+        # 不同编码是不同的表示, ETag 需要区分
+        etag = asset.etag if encoding == 'identity' else f'{asset.etag[:-1]}-{encoding}"'
+        headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+        if etag in (tag.strip() for tag in request.headers.get('if-none-match', '').split(',')):
+            return fastapi.Response(status_code=fastapi.status.HTTP_304_NOT_MODIFIED, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return fastapi.Response(content=asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+    def asset_response(self, request: fastapi.Request, filename: str) -> Optional[fastapi.Response]:
+        """文件不存在时返回 None; 带指纹的地址长期缓存, 原文件名仍可访问但每次校验"""
+        self._ensure_loaded()
+        asset = self._assets.get(filename)
+        if asset is None:
+            return None
+        immutable = filename not in self._fingerprints
+        return self._respond(request, asset, IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL)
+
+    def template_response(self, request: fastapi.Request, filename: str) -> fastapi.Response:
+        self._ensure_loaded()
+        return self._respond(request, self._templates[filename], REVALIDATE_CACHE_CONTROL)
+
+
+static_assets = StaticAssets()
@@ -0,0 +1,54 @@
+import threading
+import time
+from typing import Iterable, Optional
+import sqlmodel
+import document_sql
+
+# 查不到的名字最多每隔这么多秒触发一次整表重载, 其他进程新建的标签在此之后可见
+TAG_CACHE_RELOAD_INTERVAL = 30
+
+
+def _detached_copy(tag: document_sql.Tag) -> document_sql.Tag:
+    # 缓存里放不属于任何会话的副本, 原对象随会话提交过期或关闭后仍可安全读取
+    return document_sql.Tag(tag_id=tag.tag_id, name=tag.name, hitomi_alter=tag.hitomi_alter, group_id=tag.group_id)
+
+
+class HitomiTagCache:
+    """
+    hitomi_alter -> Tag 的进程内字典, 第一次解析时整表载入, add_tag 提交后增量写入
+    判断一本漫画缺哪些标签只需要查字典
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tags: dict[str, document_sql.Tag] = {}
+        self._loaded_at: Optional[float] = None
+
+    def load(self, session: sqlmodel.Session):
+        tags = session.exec(sqlmodel.select(document_sql.Tag)
+                            .where(sqlmodel.col(document_sql.Tag.hitomi_alter).is_not(None))).all()
+        mapping = {tag.hitomi_alter: _detached_copy(tag) for tag in tags}
+        with self._lock:
+            self._tags = mapping
+            self._loaded_at = time.monotonic()
+
+    def put(self, tag: document_sql.Tag):
+        if tag.hitomi_alter is None:
+            return
+        with self._lock:
+            if self._loaded_at is not None:
+                self._tags[tag.hitomi_alter] = _detached_copy(tag)
+
+    def resolve(self, session: sqlmodel.Session, hitomi_names: Iterable[str]) -> dict[str, document_sql.Tag]:
+        """一次解析一组 hitomi 标签名, 返回其中已入库的部分"""
+        hitomi_names = set(hitomi_names)
+        with self._lock:
+            loaded_at = self._loaded_at
+            missing = hitomi_names - self._tags.keys()
+        if loaded_at is None or (missing and time.monotonic() - loaded_at >= TAG_CACHE_RELOAD_INTERVAL):
+            self.load(session)
+        with self._lock:
+            return {name: self._tags[name] for name in hitomi_names if name in self._tags}
+
+
+hitomi_tag_cache = HitomiTagCache()
@@ -0,0 +1,177 @@
+import bisect
+import heapq
+import threading
+import time
+from array import array
+from typing import Iterable, Optional
+import sqlmodel
+import document_sql
+
+# 距离上次校验超过这么多秒, 查询前会检查数据库是否被其他进程改过
+TAG_INDEX_CHECK_INTERVAL = 30
+
+
+def _intersect(left: array, right: array) -> array:
+    """两个升序列表求交集, 短表逐个在长表里二分, 长表的搜索起点单调前进"""
+    if len(left) > len(right):
+        left, right = right, left
+    result = array('q')
+    lo = 0
+    for value in left:
+        lo = bisect.bisect_left(right, value, lo)
+        if lo == len(right):
+            break
+        if right[lo] == value:
+            result.append(value)
+    return result
+
+
+def _union(lists: Iterable[array]) -> array:
+    result = array('q')
+    for value in heapq.merge(*lists):
+        if not result or result[-1] != value:
+            result.append(value)
+    return result
+
+
+def _difference(left: array, right: array) -> array:
+    result = array('q')
+    lo = 0
+    for value in left:
+        lo = bisect.bisect_left(right, value, lo)
+        if lo < len(right) and right[lo] == value:
+            continue
+        result.append(value)
+    return result
+
+
+class TagIndex:
+    """
+    标签倒排索引: 每个标签对应一个升序的文档 id 数组
+    启动时从 document_tags 整表载入, 之后由 DocumentDB 的写方法增量维护;
+    未载入时所有维护操作都是空操作, 命令行工具不必付出载入的代价
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: dict[int, array] = {}
+        self._document_tags: dict[int, array] = {}
+        self._all_documents = array('q')
+        self._fingerprint: Optional[tuple] = None
+        self._checked_at = 0.0
+        self.loaded = False
+
+    @staticmethod
+    def _read_fingerprint(session: sqlmodel.Session) -> tuple:
+        # 行数与最大 rowid 任一变化就说明有人写过
+        return tuple(session.exec(sqlmodel.text(
+            'SELECT (SELECT count(*) FROM document_tags), (SELECT max(rowid) FROM document_tags), '
+            '(SELECT count(*) FROM documents), (SELECT max(document_id) FROM documents)'
+        )).one())
+
+    def load(self, session: sqlmodel.Session):
+        postings: dict[int, array] = {}
+        document_tags: dict[int, array] = {}
+        fingerprint = self._read_fingerprint(session)
+        links = session.exec(
+            sqlmodel.select(document_sql.DocumentTagLink.tag_id, document_sql.DocumentTagLink.document_id)
+            .order_by(document_sql.DocumentTagLink.tag_id, document_sql.DocumentTagLink.document_id)
+        ).all()
+        for tag_id, document_id in links:
+            postings.setdefault(tag_id, array('q')).append(document_id)
+            document_tags.setdefault(document_id, array('q')).append(tag_id)
+        for tags in document_tags.values():
+            tags[:] = array('q', sorted(tags))
+        all_documents = array('q', session.exec(
+            sqlmodel.select(document_sql.Document.document_id).order_by(document_sql.Document.document_id)
+        ).all())
+        with self._lock:
+            self._postings = postings
+            self._document_tags = document_tags
+            self._all_documents = all_documents
+            self._fingerprint = fingerprint
+            self._checked_at = time.monotonic()
+            self.loaded = True
+
+    def refresh_if_stale(self, session: sqlmodel.Session):
+        """其他进程 (例如命令行录入) 写库后, 最迟 TAG_INDEX_CHECK_INTERVAL 秒内重新载入"""
+        if not self.loaded or time.monotonic() - self._checked_at < TAG_INDEX_CHECK_INTERVAL:
+            return
+        fingerprint = self._read_fingerprint(session)
+        with self._lock:
+            self._checked_at = time.monotonic()
+            if fingerprint == self._fingerprint:
+                return
+        self.load(session)
+
+    @staticmethod
+    def _insert(values: array, value: int):
+        pos = bisect.bisect_left(values, value)
+        if pos == len(values) or values[pos] != value:
+            values.insert(pos, value)
+
+    @staticmethod
+    def _remove(values: array, value: int):
+        pos = bisect.bisect_left(values, value)
+        if pos < len(values) and values[pos] == value:
+            del values[pos]
+
+    def add_document(self, document_id: int):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._insert(self._all_documents, document_id)
+
+    def add_link(self, document_id: int, tag_id: int):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._insert(self._all_documents, document_id)
+            self._insert(self._postings.setdefault(tag_id, array('q')), document_id)
+            self._insert(self._document_tags.setdefault(document_id, array('q')), tag_id)
+
+    def remove_document(self, document_id: int):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._remove(self._all_documents, document_id)
+            for tag_id in self._document_tags.pop(document_id, ()):
+                self._remove(self._postings.get(tag_id, array('q')), document_id)
+
+    def query(self, all_of: Iterable[int] = (),
+              any_of: Iterable[int] = (),
+              none_of: Iterable[int] = ()) -> array:
+        """
+        返回升序的文档 id: 含有 all_of 中全部标签, 至少含有 any_of 中一个标签, 且不含 none_of 中任何标签
+        all_of 与 any_of 都为空时以全部文档为基础
+        """
+        empty = array('q')
+        with self._lock:
+            result: Optional[array] = None
+            # 从最短的倒排表开始求交集, 中间结果尽早变小
+            for posting in sorted((self._postings.get(tag_id, empty) for tag_id in set(all_of)), key=len):
+                result = posting if result is None else _intersect(result, posting)
+                if not result:
+                    return array('q')
+            any_of = set(any_of)
+            if any_of:
+                merged = _union(self._postings.get(tag_id, empty) for tag_id in any_of)
+                result = merged if result is None else _intersect(result, merged)
+            if result is None:
+                result = self._all_documents
+            none_of = set(none_of)
+            if none_of:
+                result = _difference(result, _union(self._postings.get(tag_id, empty) for tag_id in none_of))
+            return array('q', result)
+
+    def facet_counts(self, document_ids: Iterable[int]) -> dict[int, int]:
+        """统计结果集中每个标签出现在多少个文档上"""
+        counts: dict[int, int] = {}
+        with self._lock:
+            for document_id in document_ids:
+                for tag_id in self._document_tags.get(document_id, ()):
+                    counts[tag_id] = counts.get(tag_id, 0) + 1
+        return counts
+
+
+tag_index = TagIndex()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+# 各模块按相对路径读写数据库、密码文件与缓存目录, 测试在临时工作目录中进行, 收集测试模块前就要切换过去
+_workdir = Path(tempfile.mkdtemp(prefix='document_site_test_'))
+_original_cwd = os.getcwd()
+(_workdir / 'password').write_text('secret')
+for folder in ('src', 'templates'):
+    (_workdir / folder).symlink_to(REPO_ROOT / folder)
+os.chdir(_workdir)
+# app 导入时会切换到自身所在目录, 先在临时目录里导入一次, 之后各测试模块拿到的都是这一份
+with mock.patch('os.chdir'):
+    import app  # noqa: E402,F401
+
+# 种子数据: DOCUMENT_COUNT 个文档, 第 i 个带前 i % TAG_COUNT + 1 个标签
+DOCUMENT_COUNT = 40
+TAG_COUNT = 5
+# 桩服务器每个响应的大小
+STUB_PAGE_SIZE = 16 * 1024
+
+
+def pytest_unconfigure(config):
+    os.chdir(_original_cwd)
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def seeded_db() -> list[int]:
+    """在 documents.db 中写入种子数据, 返回标签 id"""
+    import document_db
+    import document_sql
+    with document_db.DocumentDB() as db:
+        db.add_source('hitomi')
+        group = document_sql.TagGroup(group_name='测试')
+        db.session.add(group)
+        db.session.commit()
+        tags = [db.add_tag(document_sql.Tag(name=f'标签{i}', group_id=group.tag_group_id, hitomi_alter=f'tag{i}'))
+                for i in range(TAG_COUNT)]
+        for i in range(DOCUMENT_COUNT):
+            doc_id = db.add_document(f'文档 {i}', f'{i}.zip', authors=[f'作者{i % 3}', '合著'], check_file=False,
+                                     source={'source_id': 1, 'source_document_id': str(1000 + i)})
+            for tag in tags[:i % TAG_COUNT + 1]:
+                db.link_document_tag(doc_id, tag)
+        return [tag.tag_id for tag in tags]
+
+
+@pytest.fixture
+def stub_server():
+    """
+    本地桩服务器模拟会限流的上游: 每个请求耗时 latency 秒, 同时处理的请求超过 throttle_above 时回 429
+    产出 (url, stats, config), 测试可以在请求前修改 config
+    """
+    stats = {'ok': 0, 'throttled': 0, 'peak': 0, 'active': 0}
+    config = {'latency': 0.02, 'throttle_above': 4}
+    lock = threading.Lock()
+    body = os.urandom(STUB_PAGE_SIZE)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            with lock:
+                stats['active'] += 1
+                stats['peak'] = max(stats['peak'], stats['active'])
+                throttled = stats['active'] > config['throttle_above']
+            try:
+                time.sleep(config['latency'])
+                if throttled:
+                    stats['throttled'] += 1
+                    self.send_response(429)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                stats['ok'] += 1
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                with lock:
+                    stats['active'] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/page', stats, config
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,80 @@
+import io
+import os
+import struct
+import zipfile
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+import app
+import document_db
+import thumbnail
+from page_cache import page_cache
+from site_utils import archived_document_path, thumbnail_folder
+from variant_cache import VARIANT_WIDTHS
+
+PAGE_COUNT = 40
+
+
+@pytest.fixture(scope='module')
+def client() -> TestClient:
+    # 不进入 lifespan, 不启动下载队列等后台任务
+    return TestClient(app.app, cookies={'password': 'secret'})
+
+
+@pytest.fixture(scope='module')
+def batch_document(seeded_db) -> int:
+    archived_document_path.mkdir(exist_ok=True)
+    with zipfile.ZipFile(archived_document_path / 'batch.zip', 'w') as zip_ref:
+        for page_no in range(PAGE_COUNT):
+            zip_ref.writestr(f'{page_no:03}.png', f'page {page_no}'.encode())
+    with document_db.DocumentDB() as db:
+        return db.add_document('批量加载', 'batch.zip', check_file=False)
+
+
+def read_frames(content: bytes) -> dict[int, bytes]:
+    frames = {}
+    while content:
+        page_no, length = struct.unpack('>II', content[:8])
+        frames[page_no] = content[8:8 + length]
+        content = content[8 + length:]
+    return frames
+
+
+@pytest.mark.parametrize('width', [None, max(VARIANT_WIDTHS) + 1])
+def test_document_batch_prefetches_next_batch_for_original_pages(client, batch_document, width):
+    # 比所有档位都宽的请求发的也是原图, 同样要预读下一批
+    start = 0 if width is None else 20
+    before = page_cache.stats()['prefetches']
+    params = {'start': start, 'count': 4} if width is None else {'start': start, 'count': 4, 'w': width}
+    response = client.get(f'/document_batch/{batch_document}', params=params)
+    assert response.status_code == 200
+    assert read_frames(response.content) == {page_no: f'page {page_no}'.encode()
+                                             for page_no in range(start, start + 4)}
+    assert page_cache.stats()['prefetches'] - before == 4
+
+
+def test_default_thumbnail_ignores_legacy_file_and_tracks_regeneration(client, seeded_db):
+    archived_document_path.mkdir(exist_ok=True)
+    cover = io.BytesIO()
+    Image.new('RGB', (1200, 1800), 'white').save(cover, 'PNG')
+    with zipfile.ZipFile(archived_document_path / 'cover.zip', 'w') as zip_ref:
+        zip_ref.writestr('000.png', cover.getvalue())
+    with document_db.DocumentDB() as db:
+        doc_id = db.add_document('封面', 'cover.zip', check_file=False)
+    # 旧版留下的未缩放原图
+    Image.new('RGB', (1200, 1800), 'white').save(thumbnail_folder / f'{doc_id}.webp', 'WEBP')
+    thumbnail.render_thumbnails(doc_id, archived_document_path / 'cover.zip')
+
+    response = client.get(f'/document_content/{doc_id}/-1')
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.content)).width == thumbnail.THUMBNAIL_SIZES[0]
+    etag = response.headers['etag']
+    assert client.get(f'/document_content/{doc_id}/-1', headers={'If-None-Match': etag}).status_code == 304
+
+    # 重新生成后旧的 ETag 不再命中
+    thumbnail_path = thumbnail.get_thumbnail_path(doc_id)
+    stat = thumbnail_path.stat()
+    os.utime(thumbnail_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    response = client.get(f'/document_content/{doc_id}/-1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
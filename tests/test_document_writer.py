@@ -0,0 +1,10 @@
+import document_db
+
+
+def test_concurrent_ingest_is_batched_without_lock_errors():
+    result = document_db.stress_writer(ingest_workers=6, docs_per_worker=25, read_workers=2)
+    assert result['errors'] == []
+    assert result['reads'] > 0
+    # 并发提交的写入被合并进同一批提交
+    assert result['operations'] > result['batches'] > 0
+    assert result['operations'] / result['batches'] > 1.5
@@ -0,0 +1,89 @@
+import asyncio
+import time
+import httpx
+from conftest import STUB_PAGE_SIZE
+from download_scheduler import DownloadScheduler, FairSemaphore
+
+
+async def download_comics(scheduler: DownloadScheduler, url: str, comics: int, pages: int) -> dict[int, float]:
+    """每本 pages 页同时经 scheduler 下载, 返回 本子序号 -> 完成时间"""
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    finish_times: dict[int, float] = {}
+    start = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        async def fetch(_page: int) -> bytes:
+            response = await client.get(url)
+            response.raise_for_status()
+            return response.content
+
+        async def one_comic(comic_no: int):
+            async for _ in scheduler.fetch_all(comic_no, fetch, range(pages)):
+                pass
+            finish_times[comic_no] = time.perf_counter() - start
+
+        await asyncio.gather(*(one_comic(comic_no) for comic_no in range(comics)))
+    return finish_times
+
+
+def test_connections_are_capped_across_comics(stub_server):
+    url, stats, config = stub_server
+    # 各本各开 connections 个 worker, 合计远超上游容忍度, 调度器必须把总并发压在上限内
+    scheduler = DownloadScheduler(connections=config['throttle_above'], bandwidth=0)
+    asyncio.run(download_comics(scheduler, url, comics=6, pages=12))
+    assert stats['throttled'] == 0
+    assert stats['ok'] == 6 * 12
+    assert stats['peak'] <= config['throttle_above']
+    assert scheduler.stats()['requests'] == 6 * 12
+    assert scheduler.stats()['bytes'] == 6 * 12 * STUB_PAGE_SIZE
+
+
+def test_comics_share_connections_fairly(stub_server):
+    url, stats, config = stub_server
+    config['throttle_above'] = 100
+    scheduler = DownloadScheduler(connections=2, bandwidth=0)
+    finish_times = asyncio.run(download_comics(scheduler, url, comics=4, pages=10))
+    # 按页轮转时各本几乎同时完成; 先到先得则第一本完成时最后一本才开始
+    assert min(finish_times.values()) > 0.75 * max(finish_times.values())
+
+
+def test_fair_semaphore_rotates_between_owners():
+    async def run() -> list[str]:
+        semaphore = FairSemaphore(1)
+        await semaphore.acquire('holder')
+        granted: list[str] = []
+
+        async def waiter(owner: str):
+            await semaphore.acquire(owner)
+            granted.append(owner)
+            semaphore.release()
+
+        # a 先排了三个, b 后排三个
+        tasks = [asyncio.create_task(waiter(owner)) for owner in ('a', 'a', 'a', 'b', 'b', 'b')]
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        return granted
+
+    assert asyncio.run(run()) == ['a', 'b', 'a', 'b', 'a', 'b']
+
+
+def test_bandwidth_is_capped():
+    rate = 1024 * 1024
+    burst = 64 * 1024
+    scheduler = DownloadScheduler(connections=8, bandwidth=rate, burst=burst)
+    payload = bytes(64 * 1024)
+
+    async def fetch(_item: int) -> bytes:
+        await asyncio.sleep(0)
+        return payload
+
+    async def run() -> float:
+        start = time.perf_counter()
+        async for _ in scheduler.fetch_all('owner', fetch, range(20)):
+            pass
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    # 令牌桶先放出 burst, 其余按 rate 发放; 请求完成后才扣令牌, 最后一批可以透支
+    minimum = (20 * len(payload) - burst - 8 * len(payload)) / rate
+    assert elapsed >= minimum
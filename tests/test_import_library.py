@@ -0,0 +1,35 @@
+import json
+import document_db
+import import_library
+
+
+def test_invalid_lines_are_skipped_without_aborting_import(tmp_path, seeded_db, capsys):
+    archives = []
+    for name in ('import_a.zip', 'import_b.zip', 'import_c.zip', 'import_d.zip'):
+        archive = tmp_path / name
+        archive.write_bytes(b'')
+        archives.append(archive)
+    manifest = tmp_path / 'manifest.jsonl'
+    entries = [
+        {'title': '导入 A', 'file': str(archives[0]), 'authors': ['导入作者']},
+        {'title': '文件不存在', 'file': str(tmp_path / 'missing.zip')},
+        {'title': '没有卷号', 'file': str(archives[1]), 'series': '系列'},
+        {'file': str(archives[1])},
+        {'title': '导入 C', 'file': str(archives[2]), 'series': '系列', 'volume': 2},
+        {'title': '作者是字符串', 'file': str(archives[3]), 'authors': '导入作者'},
+        {'title': '标签不是字符串', 'file': str(archives[3]), 'tags': [1, 2]},
+    ]
+    manifest.write_text('\n'.join(json.dumps(entry, ensure_ascii=False) for entry in entries) + '\n',
+                        encoding='utf-8')
+
+    import_library.import_manifest(manifest, batch_size=len(entries))
+
+    output = capsys.readouterr()
+    assert '新增 2, 跳过 0, 不合格 5' in output.out
+    for line_no in (2, 3, 4, 6, 7):
+        assert f'第{line_no}行不合格' in output.out + output.err
+    with document_db.DocumentDB() as db:
+        assert db.search_by_file('import_a.zip').title == '导入 A'
+        assert db.search_by_file('import_b.zip') is None
+        assert db.search_by_file('import_c.zip').title == '导入 C'
+        assert db.search_by_file('import_d.zip') is None
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import zipfile
+from types import SimpleNamespace
+import httpx
+import pytest
+
+pytest.importorskip('hitomiv2')
+pytest.importorskip('aioconsole')
+import log_comic  # noqa: E402
+from download_scheduler import DownloadScheduler  # noqa: E402
+from site_utils import get_checkpoint_path, get_zip_namelist  # noqa: E402
+
+
+def make_comic(comic_id: int, names: list[str]) -> SimpleNamespace:
+    return SimpleNamespace(id=comic_id, title=f'comic {comic_id}', files=[SimpleNamespace(name=name) for name in names])
+
+
+def page_content(comic, page) -> bytes:
+    return f'{comic.id}:{comic.files.index(page)}'.encode()
+
+
+@pytest.fixture
+def fake_download(monkeypatch):
+    """代替 hitomiv2.download_comic: 把 comic.files 里的页写成 zip, 条目名故意都用 000.webp"""
+    calls = []
+    original_files = {}
+
+    async def download_comic(comic, fo, max_threads=5, phase_callback=None):
+        await asyncio.sleep(0)
+        with zipfile.ZipFile(fo, 'w') as zip_ref:
+            for page in comic.files:
+                calls.append(page)
+                zip_ref.writestr('000.webp', page_content(original_files[comic.id], page))
+        return True
+
+    monkeypatch.setattr(log_comic, 'download_comic', download_comic)
+    return calls, original_files
+
+
+def test_entries_are_named_and_served_in_gallery_order(tmp_path, fake_download):
+    calls, original_files = fake_download
+    comic = make_comic(1, ['a.jpg', 'cover.jpg', 'a.jpg', 'Untitled-3.png'])
+    original_files[comic.id] = comic
+    raw_path = tmp_path / '1.zip'
+    asyncio.run(log_comic.download_raw_comic(comic, raw_path))
+
+    # 阅读器按 get_zip_namelist 的顺序出页
+    names = get_zip_namelist(raw_path)
+    assert names == ['0000.jpg', '0001.jpg', '0002.jpg', '0003.png']
+    with zipfile.ZipFile(raw_path) as zip_ref:
+        assert [zip_ref.read(name) for name in names] == [page_content(comic, page) for page in comic.files]
+    assert not get_checkpoint_path(raw_path).exists()
+
+
+def test_resume_fetches_only_missing_pages(tmp_path, fake_download, monkeypatch):
+    calls, original_files = fake_download
+    comic = make_comic(2, [f'{i}.webp' for i in range(20)])
+    original_files[comic.id] = comic
+    raw_path = tmp_path / '2.zip'
+    original_fetch = log_comic.fetch_page
+
+    async def failing_fetch(comic_arg, page):
+        if page is comic.files[12]:
+            raise RuntimeError('boom')
+        return await original_fetch(comic_arg, page)
+
+    monkeypatch.setattr(log_comic, 'fetch_page', failing_fetch)
+    with pytest.raises(RuntimeError):
+        asyncio.run(log_comic.download_raw_comic(comic, raw_path))
+    monkeypatch.setattr(log_comic, 'fetch_page', original_fetch)
+    checkpointed = len(get_checkpoint_path(raw_path).read_text(encoding='utf-8').splitlines())
+    assert checkpointed > 0
+    calls.clear()
+
+    digest, _ = asyncio.run(log_comic.download_raw_comic(comic, raw_path))
+    # 第一次写入并记进检查点的页不再下载
+    assert len(calls) == len(comic.files) - checkpointed
+    assert digest == hashlib.md5(raw_path.read_bytes()).hexdigest()
+    assert get_zip_namelist(raw_path) == log_comic.page_entry_names(comic.files)
+    with zipfile.ZipFile(raw_path) as zip_ref:
+        assert zip_ref.testzip() is None
+
+
+def test_per_page_downloads_respect_global_connection_limit(tmp_path, stub_server, monkeypatch):
+    url, stats, config = stub_server
+    scheduler = DownloadScheduler(connections=config['throttle_above'], bandwidth=0)
+    monkeypatch.setattr(log_comic, 'download_scheduler', scheduler)
+
+    async def download_comic(comic, fo, max_threads=5, phase_callback=None):
+        # 与 hitomiv2 一样每次调用自建客户端, 每次最多 max_threads 个并发
+        async with httpx.AsyncClient(timeout=30) as client:
+            with zipfile.ZipFile(fo, 'w') as zip_ref:
+                for page in comic.files:
+                    response = await client.get(url)
+                    response.raise_for_status()
+                    zip_ref.writestr(page.name, response.content)
+        return True
+
+    monkeypatch.setattr(log_comic, 'download_comic', download_comic)
+    comics = [make_comic(comic_id, [f'{i}.webp' for i in range(8)]) for comic_id in range(10, 14)]
+
+    async def run():
+        await asyncio.gather(*(log_comic.download_raw_comic(comic, tmp_path / f'{comic.id}.zip') for comic in comics))
+
+    asyncio.run(run())
+    assert stats['throttled'] == 0
+    assert stats['ok'] == 4 * 8
+    assert stats['peak'] <= config['throttle_above']
+    for comic in comics:
+        assert get_zip_namelist(tmp_path / f'{comic.id}.zip') == log_comic.page_entry_names(comic.files)
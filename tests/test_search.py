@@ -0,0 +1,139 @@
+import pytest
+import sqlalchemy
+import app
+import document_db
+from conftest import DOCUMENT_COUNT, TAG_COUNT
+from tag_index import tag_index
+
+PAGE_SIZES = (2, 5, 10)
+
+
+@pytest.fixture
+def db(seeded_db):
+    with document_db.DocumentDB() as database:
+        yield database
+
+
+@pytest.fixture(autouse=True)
+def unload_tag_index():
+    # 带标签的检索会按需载入标签索引, 每个测试都从未载入开始
+    tag_index.loaded = False
+    yield
+    tag_index.loaded = False
+
+
+@pytest.fixture
+def loaded_tag_index(db):
+    tag_index.load(db.session)
+    return tag_index
+
+
+def search_titles(db: document_db.DocumentDB, monkeypatch: pytest.MonkeyPatch, **request_fields) -> set[str]:
+    monkeypatch.setattr(app, 'PAGE_COUNT', DOCUMENT_COUNT)
+    page = app.run_search_document(app.SearchDocumentRequest(**request_fields), db)
+    return {document.title for document in page.documents}
+
+
+def seeded_titles(predicate) -> set[str]:
+    return {f'文档 {i}' for i in range(DOCUMENT_COUNT) if predicate(i)}
+
+
+def count_statements(db: document_db.DocumentDB, request: app.SearchDocumentRequest, page_size: int,
+                     monkeypatch: pytest.MonkeyPatch) -> int:
+    """执行一次检索并序列化响应, 返回期间发出的 SQL 语句数"""
+    statements = []
+
+    def on_execute(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    monkeypatch.setattr(app, 'PAGE_COUNT', page_size)
+    # 先执行一次, 按需载入标签索引之类的一次性开销不计入
+    app.run_search_document(request, db)
+    # 总数缓存会让后面的页大小少一条 COUNT
+    document_db._count_cache.clear()
+    # 新会话, 不让上一次检索的对象留在 identity map 里
+    db.session.expunge_all()
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        page = app.run_search_document(request, db)
+        app.to_search_response(page)
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', on_execute)
+    assert len(page.documents) == page_size
+    return len(statements)
+
+
+@pytest.mark.parametrize('request_fields', [
+    {},
+    {'author_name': '合著'},
+    {'target_tag': 1},
+    {'cursor': 30, 'with_total': False},
+    {'keyword': '文档'},
+])
+def test_statement_count_independent_of_page_size(db, monkeypatch, request_fields):
+    request = app.SearchDocumentRequest(**request_fields)
+    counts = [count_statements(db, request, page_size, monkeypatch) for page_size in PAGE_SIZES]
+    assert counts[0] == counts[1] == counts[2], counts
+
+
+def test_tag_index_statement_count_independent_of_page_size(db, loaded_tag_index, monkeypatch):
+    request = app.SearchDocumentRequest(include_tags=[1], exclude_tags=[5], with_facets=True)
+    counts = [count_statements(db, request, page_size, monkeypatch) for page_size in PAGE_SIZES]
+    assert counts[0] == counts[1] == counts[2], counts
+
+
+def test_keyword_combined_with_tags(db, seeded_db, monkeypatch):
+    # 第 k 个标签只挂在 i % TAG_COUNT >= k 的文档上
+    titles = search_titles(db, monkeypatch, keyword='文档 1', target_tag=seeded_db[2])
+    assert titles == seeded_titles(lambda i: str(i).startswith('1') and i % TAG_COUNT >= 2)
+
+
+def test_keyword_combined_with_author(db, monkeypatch):
+    titles = search_titles(db, monkeypatch, keyword='文档 1', author_name='作者0')
+    assert titles == seeded_titles(lambda i: str(i).startswith('1') and i % 3 == 0)
+
+
+@pytest.mark.parametrize('keyword, predicate', [
+    ('合著', lambda i: True),
+    ('者1', lambda i: i % 3 == 1),
+    ('档 3', lambda i: str(i).startswith('3')),
+    ('作者1', lambda i: i % 3 == 1),
+])
+def test_short_keyword_searches_authors_like_fulltext(db, monkeypatch, keyword, predicate):
+    # 少于三个字符的关键词走 LIKE, 查找范围要与全文索引一致
+    assert search_titles(db, monkeypatch, keyword=keyword) == seeded_titles(predicate)
+
+
+def test_tag_filters_without_preloaded_index(db, seeded_db, monkeypatch):
+    assert not tag_index.loaded
+    titles = search_titles(db, monkeypatch, any_tags=[seeded_db[3], seeded_db[4]], exclude_tags=[seeded_db[4]])
+    assert titles == seeded_titles(lambda i: i % TAG_COUNT == 3)
+
+
+def search_page(db: document_db.DocumentDB, monkeypatch: pytest.MonkeyPatch, page_size: int,
+                **request_fields) -> app.SearchPage:
+    monkeypatch.setattr(app, 'PAGE_COUNT', page_size)
+    return app.run_search_document(app.SearchDocumentRequest(**request_fields), db)
+
+
+@pytest.mark.parametrize('request_fields', [{'author_name': '作者0'}, {'target_tag': 1, 'author_name': '作者0'}])
+def test_page_mode_next_cursor_at_exact_multiple(db, monkeypatch, request_fields):
+    # 作者0 恰有 len(matched) 本, 页大小取其约数, 最后一页不应再给出游标
+    matched = seeded_titles(lambda i: i % 3 == 0)
+    page_size = len(matched) // 2
+    first = search_page(db, monkeypatch, page_size, **request_fields)
+    assert first.next_cursor == first.documents[-1].document_id
+    second = search_page(db, monkeypatch, page_size, target_page=2, **request_fields)
+    assert second.next_cursor is None
+    by_cursor = search_page(db, monkeypatch, page_size, cursor=first.next_cursor, **request_fields)
+    assert by_cursor.next_cursor is None
+    assert [document.document_id for document in by_cursor.documents] == \
+           [document.document_id for document in second.documents]
+    single = search_page(db, monkeypatch, len(matched), **request_fields)
+    assert len(single.documents) == len(matched) and single.next_cursor is None
+
+
+@pytest.mark.parametrize('request_fields', [{}, {'keyword': '文档 1'}, {'target_tag': 1}])
+def test_page_mode_honors_with_total(db, monkeypatch, request_fields):
+    assert search_page(db, monkeypatch, 5, target_page=2, with_total=False, **request_fields).total_count is None
+    assert search_page(db, monkeypatch, 5, target_page=2, **request_fields).total_count is not None
@@ -0,0 +1,24 @@
+import threading
+import shared
+
+
+def test_task_status_snapshot_while_other_thread_mutates():
+    stop = threading.Event()
+
+    def mutate():
+        while not stop.is_set():
+            for key in range(200):
+                shared.update_task_status(f'snapshot-{key}', title=str(key))
+            for key in range(200):
+                shared.remove_task_status(f'snapshot-{key}')
+
+    thread = threading.Thread(target=mutate)
+    thread.start()
+    try:
+        for _ in range(2000):
+            # 与 SSE 的 snapshot 一样在另一个线程修改期间遍历
+            for key, status in shared.get_task_status_snapshot().items():
+                status.model_dump()
+    finally:
+        stop.set()
+        thread.join()
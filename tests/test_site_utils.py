@@ -0,0 +1,38 @@
+import hashlib
+import random
+import zipfile
+import psutil
+from site_utils import iter_zip_entry
+
+MiB = 1024 * 1024
+ENTRY_SIZE = 32 * MiB
+# 流式读取期间常驻内存最多增长这么多, 远小于条目本身
+RSS_GROWTH_LIMIT = 8 * MiB
+
+
+def test_iter_zip_entry_streams_deflated_entry_in_bounded_memory(tmp_path):
+    zip_path = tmp_path / 'large.zip'
+    rng = random.Random(0)
+    expected = hashlib.md5()
+    # 一半随机一半零, deflate 后约为原大小的一半; 分块写入, 造数据本身不占多少内存
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        with zip_ref.open('large.bin', 'w', force_zip64=True) as entry:
+            for _ in range(ENTRY_SIZE // MiB):
+                block = rng.randbytes(MiB // 2) + bytes(MiB // 2)
+                expected.update(block)
+                entry.write(block)
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        assert zip_ref.getinfo('large.bin').compress_type == zipfile.ZIP_DEFLATED
+
+    process = psutil.Process()
+    baseline = process.memory_info().rss
+    peak = baseline
+    actual = hashlib.md5()
+    size = 0
+    for chunk in iter_zip_entry(zip_path, 'large.bin'):
+        actual.update(chunk)
+        size += len(chunk)
+        peak = max(peak, process.memory_info().rss)
+    assert size == ENTRY_SIZE
+    assert actual.hexdigest() == expected.hexdigest()
+    assert peak - baseline < RSS_GROWTH_LIMIT, f'RSS 增长 {(peak - baseline) / MiB:.1f} MiB'
@@ -0,0 +1,34 @@
+import threading
+import time
+import thumbnail
+
+
+def test_concurrent_first_calls_create_one_executor(monkeypatch):
+    created = []
+
+    class SlowExecutor(thumbnail.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            # 拉长创建过程, 让并发的首次调用一定重叠
+            time.sleep(0.05)
+            created.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(thumbnail, 'ProcessPoolExecutor', SlowExecutor)
+    thumbnail.shutdown_executor()
+    barrier = threading.Barrier(16)
+    results = []
+
+    def first_call():
+        barrier.wait()
+        results.append(thumbnail.get_executor())
+
+    threads = [threading.Thread(target=first_call) for _ in range(16)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(created) == 1
+        assert all(executor is created[0] for executor in results)
+    finally:
+        thumbnail.shutdown_executor()
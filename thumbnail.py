@@ -0,0 +1,97 @@
+import asyncio
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Sequence
+import natsort
+from PIL import Image
+from site_utils import SingleFlight, atomic_write, thumbnail_folder
+
+# 缩略图宽度列表, 第一个是默认尺寸, 都存为 {id}_{宽度}.webp
+# 旧版的 {id}.webp 是未缩放的原图, 不再使用, 缺少新文件的文档会重新生成
+THUMBNAIL_SIZES: tuple[int, ...] = tuple(int(w) for w in os.environ.get('THUMBNAIL_SIZES', '360,720').split(','))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', min(4, os.cpu_count() or 1)))
+
+_executor: Optional[ProcessPoolExecutor] = None
+# 请求线程与 variant_cache 都会调用 get_executor, 首次并发调用时只能建出一个进程池
+_executor_lock = threading.Lock()
+# 同一文档的缩略图同时只生成一次
+_thumbnail_flight = SingleFlight()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    executor = _executor
+    if executor is not None:
+        return executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_thumbnail_path(document_id: int, width: Optional[int] = None) -> Path:
+    return thumbnail_folder / Path(f'{document_id}_{width or THUMBNAIL_SIZES[0]}.webp')
+
+
+def has_thumbnails(document_id: int, sizes: Sequence[int] = THUMBNAIL_SIZES) -> bool:
+    return all(get_thumbnail_path(document_id, width).exists() for width in sizes)
+
+
+def resize_to_width(image: Image.Image, width: int) -> Image.Image:
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    if image.width <= width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def render_thumbnails(document_id: int, archive_path: Path,
+                      sizes: Sequence[int] = THUMBNAIL_SIZES) -> list[Path]:
+    """
+    在工作进程中执行: 取归档自然排序后的第一页, 按各尺寸缩放后写入缩略图目录
+    先写临时文件再改名, 不会留下写了一半的 webp
+    """
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        pic_list = natsort.natsorted(info.filename for info in zip_ref.infolist() if not info.is_dir())
+        if not pic_list:
+            return []
+        with zip_ref.open(pic_list[0]) as img_file:
+            source = Image.open(img_file)
+            source.load()
+    thumbnail_folder.mkdir(exist_ok=True)
+    written = []
+    for width in sizes:
+        target_path = get_thumbnail_path(document_id, width)
+        with atomic_write(target_path) as fo:
+            resize_to_width(source, width).save(fo, 'WEBP', quality=THUMBNAIL_QUALITY)
+        written.append(target_path)
+    return written
+
+
+def _generate_once(document_id: int, archive_path: Path) -> list[Path]:
+    # 排在前一轮之后进来的调用方可能发现已经生成好了
+    if has_thumbnails(document_id):
+        return [get_thumbnail_path(document_id, width) for width in THUMBNAIL_SIZES]
+    return get_executor().submit(render_thumbnails, document_id, archive_path).result()
+
+
+def generate_thumbnails_sync(document_id: int, archive_path: Path) -> list[Path]:
+    """给同步的请求处理函数用, 解码与缩放在进程池里完成, 并发请求同一文档时只算一次"""
+    return _thumbnail_flight.do(document_id, _generate_once, document_id, archive_path)
+
+
+async def generate_thumbnails(document_id: int, archive_path: Path) -> list[Path]:
+    return await asyncio.to_thread(generate_thumbnails_sync, document_id, archive_path)
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence
+from PIL import Image
+import thumbnail
+from site_utils import ArchiveIndex, SingleFlight, atomic_write, read_zip_entry
+
+variant_folder = Path('variant_cache')
+if not variant_folder.exists():
+    variant_folder.mkdir()
+
+# 允许的目标宽度, 请求的宽度向上取整到其中之一, 避免缓存被任意宽度撑爆
+VARIANT_WIDTHS: tuple[int, ...] = tuple(int(w) for w in os.environ.get('VARIANT_WIDTHS', '480,720,1080,1440').split(','))
+VARIANT_QUALITY = int(os.environ.get('VARIANT_QUALITY', 80))
+# 变体缓存的磁盘占用上限 (字节)
+VARIANT_CACHE_BYTES = int(os.environ.get('VARIANT_CACHE_BYTES', 2 * 1024 * 1024 * 1024))
+MAX_PASSTHROUGH_ENTRIES = 65536
+
+
+def snap_width(width: int, choices: Sequence[int] = VARIANT_WIDTHS) -> Optional[int]:
+    """取不小于请求宽度的最小档位, 比所有档位都大时返回 None, 即直接用原图"""
+    for choice in sorted(choices):
+        if choice >= width:
+            return choice
+    return None
+
+
+def render_variant(content: bytes, width: int, target_path: Path) -> Optional[Path]:
+    """在工作进程中执行: 缩放并重新编码为 webp. 原图本来就不宽于目标时返回 None"""
+    source = Image.open(io.BytesIO(content))
+    if source.width <= width:
+        return None
+    with atomic_write(target_path) as fo:
+        thumbnail.resize_to_width(source, width).save(fo, 'WEBP', quality=VARIANT_QUALITY)
+    return target_path
+
+
+class VariantCache:
+    """
+    缩放后页面的磁盘缓存, 以 归档哈希 + 条目名 + 宽度 为键
+    总大小超过上限时按最近使用时间淘汰, 命中时更新 mtime, 重启后顺序依然有效
+    """
+
+    def __init__(self, folder: Path = variant_folder, max_bytes: int = VARIANT_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._entries: OrderedDict[Path, int] = OrderedDict()
+        # 记住原图已经足够小的条目, 免得每次都解码一遍才发现不用缩放
+        self._passthrough: OrderedDict[Path, None] = OrderedDict()
+        self.current_bytes = 0
+        self._load()
+
+    def _load(self):
+        files = []
+        for path in self.folder.glob('*.webp'):
+            st = path.stat()
+            files.append((st.st_mtime_ns, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self.current_bytes += size
+
+    def get_variant_path(self, index: ArchiveIndex, name: str, width: int) -> Path:
+        # 归档文件名本身就是内容哈希
+        entry_hash = hashlib.md5(name.encode()).hexdigest()[:16]
+        return self.folder / Path(f'{index.zip_path.stem}_{entry_hash}_{width}.webp')
+
+    def _touch(self, path: Path):
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _add(self, path: Path):
+        size = path.stat().st_size
+        evicted: list[Path] = []
+        with self._lock:
+            self.current_bytes -= self._entries.pop(path, 0)
+            self._entries[path] = size
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self.current_bytes -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            old_path.unlink(missing_ok=True)
+
+    def _generate(self, index: ArchiveIndex, name: str, width: int, target_path: Path) -> Optional[Path]:
+        if target_path.exists():
+            return target_path
+        content = read_zip_entry(index.zip_path, name)
+        if content is None:
+            return None
+        future = thumbnail.get_executor().submit(render_variant, content, width, target_path)
+        result = future.result()
+        if result is not None:
+            self._add(result)
+        else:
+            with self._lock:
+                self._passthrough[target_path] = None
+                while len(self._passthrough) > MAX_PASSTHROUGH_ENTRIES:
+                    self._passthrough.popitem(last=False)
+        return result
+
+    def get(self, index: ArchiveIndex, name: str, width: int) -> Optional[Path]:
+        """返回缩放后的文件路径, 原图不比目标宽时返回 None, 调用方应直接发原图"""
+        target_path = self.get_variant_path(index, name, width)
+        with self._lock:
+            if target_path in self._passthrough:
+                return None
+        if target_path.exists():
+            self._touch(target_path)
+            return target_path
+        return self._flight.do(target_path, self._generate, index, name, width, target_path)
+
+
+variant_cache = VariantCache()